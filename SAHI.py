@@ -7,7 +7,7 @@ VERSÃO: 3.0 (18/02/26) - SAHI INTEGRADO
 
 
 FUNCIONALIDADE:
-1. Carrega modelo YOLOv11 (PyTorch .pt)
+1. Carrega modelo YOLOv11 (PyTorch .pt, ou exportado para NCNN/ONNX)
 2. Executa inferência com SLICING (SAHI) para detetar objetos pequenos
 3. Mostra deteções (classe + confiança + bounding boxes)
 4. Suporta processamento de imagem única ou pasta completa
@@ -16,6 +16,8 @@ FUNCIONALIDADE:
 EXECUÇÃO: 
    python3 yolo_test_pi.py --image ./test.jpg
    python3 yolo_test_pi.py --input-dir ./camera_test_images/ --slice-size 640
+   python3 yolo_test_pi.py --image ./test.jpg --export ncnn
+   python3 yolo_test_pi.py --watch ./captured_images/   (serviço: processa imagens novas)
 
 
 VANTAGENS DO SAHI:
@@ -25,13 +27,35 @@ VANTAGENS DO SAHI:
 """
 
 
+import os
 import sys
+import json
+import time
+import queue
 import argparse
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 
+# Threads de inferência: 3 dos 4 cores do Pi 5, o core 0 fica para câmera/descodificação
+# (variáveis de ambiente têm de ser definidas antes de importar numpy/torch)
+INFERENCE_THREADS = 3
+INFERENCE_CORES = {1, 2, 3}
+DECODE_CORES = {0}  # Thread de descodificação (prefetch) da imagem seguinte
+for _var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+    os.environ.setdefault(_var, str(INFERENCE_THREADS))
+
+
+import numpy as np
+from PIL import Image
+
+
 # Tenta importar Ultralytics YOLO
 try:
+    import torch
     from ultralytics import YOLO
 except ImportError:
     print("ERRO: Ultralytics não instalado")
@@ -42,13 +66,31 @@ except ImportError:
 # Tenta importar SAHI
 try:
     from sahi import AutoDetectionModel
-    from sahi.predict import get_sliced_prediction
+    from sahi.predict import get_sliced_prediction, POSTPROCESS_NAME_TO_CLASS
+    from sahi.prediction import ObjectPrediction
+    from sahi.slicing import get_slice_bboxes
+    from sahi.utils.cv import read_image_as_pil
 except ImportError:
     print("ERRO: SAHI não instalado")
     print("Execute: pip install sahi")
     sys.exit(1)
 
 
+# PyTurboJPEG é opcional: descodifica JPEG com libjpeg-turbo (NEON) sem passar pelo PIL
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_GRAY
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
+
+
+# Numba é opcional: sem ele o NMS corre em NumPy puro (mais lento)
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
 print("="*60)
 print("TESTE DE INFERÊNCIA - YOLOv11 + SAHI no Raspberry Pi 5")
 print("="*60)
@@ -63,6 +105,14 @@ print("="*60)
 DEFAULT_MODEL = "yolo11s.pt"
 
 
+# Formatos de exportação (runtimes otimizados para ARM/CPU)
+# ncnn: kernels NEON, pesos em FP16 | onnx: ONNXRuntime CPU, batch dinâmico
+EXPORT_FORMATS = {
+    'ncnn': {'half': True},
+    'onnx': {'dynamic': True, 'simplify': True},
+}
+
+
 # Threshold de confiança mínimo para deteções
 CONFIDENCE_THRESHOLD = 0.25
 
@@ -71,10 +121,60 @@ CONFIDENCE_THRESHOLD = 0.25
 DEFAULT_SLICE_HEIGHT = 640      # Altura de cada tile
 DEFAULT_SLICE_WIDTH = 640       # Largura de cada tile
 DEFAULT_OVERLAP_RATIO = 0.2     # Sobreposição entre tiles (20%)
+DEFAULT_BATCH_SIZE = 8          # Tiles por forward pass do YOLO (1 = sequencial SAHI)
+SINGLE_TILE_MAX_RATIO = 1.25    # Imagens até 1.25x o tile (ex: zoom 4x) vão direto ao YOLO
+
+
+# SAHI: Junção de deteções duplicadas nas zonas de overlap
+# NMS = descarta duplicados (rápido, Numba) | NMM = funde caixas (GreedyNMM do SAHI, Python)
+POSTPROCESS_TYPES = {'NMS': 'NMS', 'NMM': 'GREEDYNMM'}
+DEFAULT_POSTPROCESS = 'NMS'
+DEFAULT_MATCH_METRIC = 'IOS'         # IOS = interseção / área da caixa menor
+DEFAULT_MATCH_THRESHOLD = 0.3        # Baixo p/ insetos densos sobrepostos
+
+
+# Modo serviço (--watch): ficheiros que aparecem sem evento de fecho (ex: mv de
+# outra pasta/disco) são processados quando o tamanho não muda neste intervalo
+WATCH_SETTLE_SECONDS = 1.0
 
 
 # Formatos de imagem suportados 
-SUPPORTED_FORMATS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
+SUPPORTED_FORMATS = frozenset({'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'})
+
+
+# ============================================================================
+# FUNÇÃO: CONFIGURAR THREADS / CORES
+# ============================================================================
+
+
+def can_pin_cores():
+    """Só em Linux e se os cores existirem (ex: não aplica num PC de 2 cores)"""
+    return hasattr(os, 'sched_setaffinity') and max(INFERENCE_CORES) < (os.cpu_count() or 1)
+
+
+def configure_cpu_threads():
+    """Fixa 1 thread inter-op no PyTorch e fixa o processo nos INFERENCE_CORES"""
+    # Inter-op só pode ser definido antes do 1º trabalho paralelo do PyTorch
+    torch.set_num_interop_threads(1)
+    
+    if can_pin_cores():
+        os.sched_setaffinity(0, INFERENCE_CORES)
+        print(f"✓ Inferência fixada nos cores {sorted(INFERENCE_CORES)} ({INFERENCE_THREADS} threads)")
+
+
+def apply_inference_threads():
+    """Repõe INFERENCE_THREADS no PyTorch (chamar depois do 1º predict)"""
+    # O 1º predict do Ultralytics (select_device) faz torch.set_num_threads(min(8, cores - 1)):
+    # só coincide com INFERENCE_THREADS no Pi 5, noutros CPUs seria outro valor
+    torch.set_num_threads(INFERENCE_THREADS)
+
+
+def pin_decoder_thread():
+    """Fixa a thread atual nos DECODE_CORES (initializer do ThreadPoolExecutor de prefetch)"""
+    # Threads criadas depois do sched_setaffinity herdam os INFERENCE_CORES; com
+    # pid 0 o Linux aplica a máscara só à thread que chama
+    if can_pin_cores():
+        os.sched_setaffinity(0, DECODE_CORES)
 
 
 # ============================================================================
@@ -82,27 +182,68 @@ SUPPORTED_FORMATS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
 # ============================================================================
 
 
+def export_model(model_path, export_format, imgsz):
+    """Exporta modelo .pt para NCNN/ONNX (só na primeira vez)"""
+    pt_path = Path(model_path)
+    if export_format == 'ncnn':
+        exported_path = pt_path.with_name(f"{pt_path.stem}_ncnn_model")
+    else:
+        exported_path = pt_path.with_suffix(f".{export_format}")
+    
+    # Reutiliza exportação anterior
+    if exported_path.exists():
+        print(f"\n✓ Modelo exportado já existe: {exported_path}")
+        return str(exported_path)
+    
+    print(f"\n[0/3] A exportar {model_path} para {export_format.upper()} (pode demorar)...")
+    try:
+        exported = YOLO(model_path).export(
+            format=export_format,
+            imgsz=imgsz,
+            **EXPORT_FORMATS[export_format]
+        )
+        print(f"✓ Modelo exportado: {exported}")
+        return str(exported)
+    except Exception as e:
+        print(f"✗ Erro ao exportar modelo: {e}")
+        return None
+
+
 def load_model_with_sahi(model_path, conf_threshold):
     """Carrega modelo YOLOv11 com wrapper SAHI"""
     print(f"\n[1/3] A carregar o modelo: {model_path}")
     
     is_standard_model = model_path.startswith("yolo") and model_path.endswith(".pt")
     
+    # Modelos exportados: Ultralytics escolhe o runtime pelo nome
+    if model_path.rstrip('/').endswith('_ncnn_model'):
+        backend = "NCNN"
+    elif model_path.endswith('.onnx'):
+        backend = "ONNXRuntime"
+    else:
+        backend = "PyTorch"
+    
     if not is_standard_model and not Path(model_path).exists():
         print(f"✗ Modelo local não encontrado: {model_path}")
         return None
     
     try:
+        # O YOLO é criado aqui e passado já pronto ao SAHI (model=): o load_model
+        # do SAHI faz model.to(device), que o Ultralytics recusa (TypeError) em
+        # modelos exportados (NCNN/ONNX)
+        yolo_model = YOLO(model_path, task='detect')
+        
         # SAHI AutoDetectionModel wrapper para Ultralytics YOLO
         detection_model = AutoDetectionModel.from_pretrained(
             model_type='yolov8',       # SAHI usa 'yolov8' para ultralytics
+            model=yolo_model,
             model_path=model_path,
             confidence_threshold=conf_threshold,
             device='cpu'               # Raspberry Pi não tem GPU
         )
         
         print(f"✓ Modelo carregado com SAHI wrapper")
-        print(f"  Framework: Ultralytics YOLO")
+        print(f"  Framework: Ultralytics YOLO ({backend})")
         print(f"  Device: CPU")
         return detection_model
         
@@ -111,35 +252,334 @@ def load_model_with_sahi(model_path, conf_threshold):
         return None
 
 
+def warmup_model(detection_model, slice_size):
+    """Forward pass com imagem vazia (inicializa threads/kernels antes da 1ª imagem real)"""
+    print(f"  A aquecer o modelo ({slice_size}x{slice_size})...")
+    detection_model.model(
+        np.zeros((slice_size, slice_size, 3), dtype=np.uint8),
+        imgsz=slice_size,
+        device='cpu',
+        verbose=False
+    )
+
+
+# ============================================================================
+# ESTRUTURA: DETEÇÕES EM ARRAYS (SoA)
+# ============================================================================
+
+
+# Um array NumPy por campo em vez de um ObjectPrediction (+ BoundingBox, Category,
+# Score) por deteção: filtros, NMS e output trabalham sobre arrays contíguos
+# boxes: (N,4) xyxy | scores: (N,) | class_ids: (N,) | names: {class_id: nome}
+Detections = namedtuple('Detections', ['boxes', 'scores', 'class_ids', 'names'])
+
+
+def select_detections(detections, index):
+    """Subconjunto das deteções (máscara booleana ou índices)"""
+    return Detections(
+        detections.boxes[index],
+        detections.scores[index],
+        detections.class_ids[index],
+        detections.names
+    )
+
+
+def predictions_to_detections(object_prediction_list, names):
+    """Converte a lista de ObjectPrediction do SAHI para Detections"""
+    count = len(object_prediction_list)
+    boxes = np.array(
+        [[p.bbox.minx, p.bbox.miny, p.bbox.maxx, p.bbox.maxy] for p in object_prediction_list],
+        dtype=np.float64
+    ).reshape(count, 4)
+    scores = np.fromiter((p.score.value for p in object_prediction_list), dtype=np.float64, count=count)
+    class_ids = np.fromiter((p.category.id for p in object_prediction_list), dtype=np.int32, count=count)
+    return Detections(boxes, scores, class_ids, names)
+
+
+def detections_to_predictions(detections, full_shape):
+    """Materializa ObjectPrediction do SAHI (só para o GreedyNMM)"""
+    return [
+        ObjectPrediction(
+            bbox=box,
+            category_id=class_id,
+            category_name=detections.names.get(class_id, str(class_id)),
+            score=score,
+            full_shape=full_shape
+        )
+        for box, score, class_id in zip(
+            detections.boxes.tolist(), detections.scores.tolist(), detections.class_ids.tolist()
+        )
+    ]
+
+
+# ============================================================================
+# FUNÇÃO: NMS RÁPIDO (NUMBA JIT)
+# ============================================================================
+
+
+def _nms_numpy(boxes, scores, classes, match_threshold, use_ios):
+    """NMS por classe sobre arrays (N,4) xyxy, vetorizado em NumPy (fallback)"""
+    order = np.argsort(-scores)
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    suppressed = np.zeros(scores.shape[0], dtype=np.bool_)
+    keep = []
+    
+    for idx in range(order.shape[0]):
+        i = order[idx]
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        
+        # Compara a caixa i com todas as de score inferior
+        rest = order[idx + 1:]
+        inter_w = np.maximum(0.0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+        inter_h = np.maximum(0.0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+        inter = inter_w * inter_h
+        if use_ios:
+            denom = np.minimum(areas[i], areas[rest])
+        else:
+            denom = areas[i] + areas[rest] - inter
+        overlap = (inter > match_threshold * denom) & (classes[rest] == classes[i])
+        suppressed[rest[overlap]] = True
+    
+    return keep
+
+
+def _nms_loop(boxes, scores, classes, match_threshold, use_ios):
+    """NMS por classe sobre arrays (N,4) xyxy, em loops escalares (para Numba)"""
+    order = np.argsort(-scores)
+    n = order.shape[0]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    suppressed = np.zeros(n, dtype=np.bool_)
+    keep = np.empty(n, dtype=np.int64)
+    num_keep = 0
+    
+    for a in range(n):
+        i = order[a]
+        if suppressed[i]:
+            continue
+        keep[num_keep] = i
+        num_keep += 1
+        
+        for b in range(a + 1, n):
+            j = order[b]
+            if suppressed[j] or classes[j] != classes[i]:
+                continue
+            inter_w = min(boxes[i, 2], boxes[j, 2]) - max(boxes[i, 0], boxes[j, 0])
+            inter_h = min(boxes[i, 3], boxes[j, 3]) - max(boxes[i, 1], boxes[j, 1])
+            if inter_w <= 0.0 or inter_h <= 0.0:
+                continue
+            inter = inter_w * inter_h
+            if use_ios:
+                denom = min(areas[i], areas[j])
+            else:
+                denom = areas[i] + areas[j] - inter
+            if inter > match_threshold * denom:
+                suppressed[j] = True
+    
+    return keep[:num_keep]
+
+
+# Com Numba o loop escalar é compilado para código nativo (sem alocações por caixa)
+_nms_kernel = njit(cache=True)(_nms_loop) if njit is not None else _nms_numpy
+
+
+def fast_nms(detections, match_threshold, match_metric):
+    """NMS sobre Detections (substitui o GreedyNMM do SAHI em Python)"""
+    keep = _nms_kernel(
+        detections.boxes,
+        detections.scores,
+        detections.class_ids,
+        float(match_threshold),
+        match_metric == "IOS"
+    )
+    return select_detections(detections, np.asarray(keep, dtype=np.int64))
+
+
 # ============================================================================
 # FUNÇÃO: EXECUTAR INFERÊNCIA COM SAHI SLICING
 # ============================================================================
 
 
-def run_sahi_inference(detection_model, image_path, slice_height, slice_width, overlap_ratio):
-    """Executa inferência YOLOv11 + SAHI com slicing"""
-    print(f"\n[2/3] Inferência SAHI em: {Path(image_path).name}")
-    print(f"  Slice size: {slice_width}x{slice_height}")
-    print(f"  Overlap: {overlap_ratio*100:.0f}%")
+def load_image(image_path, grayscale=False):
+    """Descodifica a imagem para array RGB (TurboJPEG se disponível, senão PIL)"""
+    if isinstance(image_path, np.ndarray):
+        return image_path
+    is_jpeg = Path(image_path).suffix.lower() in ('.jpg', '.jpeg')
+    
+    if grayscale:
+        # Só luminância (Y): o JPEG não descodifica nem converte os planos de cor
+        if turbo_jpeg is not None and is_jpeg:
+            with open(image_path, 'rb') as f:
+                gray = turbo_jpeg.decode(f.read(), pixel_format=TJPF_GRAY)
+        else:
+            with Image.open(image_path) as img:
+                img.draft('L', img.size)
+                gray = np.asarray(img.convert('L'))[:, :, None]
+        # Replica Y para 3 canais sem copiar memória (stride 0)
+        return np.broadcast_to(gray, gray.shape[:2] + (3,))
     
+    if turbo_jpeg is not None and is_jpeg:
+        with open(image_path, 'rb') as f:
+            return turbo_jpeg.decode(f.read(), pixel_format=TJPF_RGB)
+    return np.asarray(read_image_as_pil(str(image_path)))
+
+
+def readahead_file(file_path):
+    """Pede ao kernel para ler o ficheiro para a page cache em background (SD lento)"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
     try:
-        # SAHI sliced prediction
-        result = get_sliced_prediction(
-            image=str(image_path),
-            detection_model=detection_model,
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+@lru_cache(maxsize=8)
+def get_slice_grid(image_height, image_width, slice_height, slice_width, overlap_ratio):
+    """Grelha de tiles (x1, y1, x2, y2), calculada uma vez por resolução"""
+    return tuple(
+        tuple(bbox) for bbox in get_slice_bboxes(
+            image_height=image_height,
+            image_width=image_width,
             slice_height=slice_height,
             slice_width=slice_width,
             overlap_height_ratio=overlap_ratio,
             overlap_width_ratio=overlap_ratio,
-            verbose=0
         )
+    )
+
+
+def fits_single_tile(image_height, image_width, slice_height, slice_width):
+    """True se a imagem é pequena o suficiente para dispensar o slicing"""
+    return (image_height <= slice_height * SINGLE_TILE_MAX_RATIO
+            and image_width <= slice_width * SINGLE_TILE_MAX_RATIO)
+
+
+def get_batched_sliced_prediction(detection_model, image, slice_height, slice_width,
+                                  overlap_ratio, batch_size, postprocess=DEFAULT_POSTPROCESS,
+                                  match_metric=DEFAULT_MATCH_METRIC,
+                                  match_threshold=DEFAULT_MATCH_THRESHOLD):
+    """Slicing SAHI com inferência em batch (vários tiles por forward pass)"""
+    # Descodifica a imagem uma só vez (RGB); os tiles são views sem cópia
+    image_array = load_image(image)
+    height, width = image_array.shape[:2]
+    names = detection_model.model.names
+    
+    if fits_single_tile(height, width, slice_height, slice_width):
+        # Imagem inteira num só forward pass (sem cortes nem NMS entre tiles)
+        grid = ((0, 0, width, height),)
+    else:
+        # Mesma grelha que o get_sliced_prediction, reutilizada entre imagens iguais
+        grid = get_slice_grid(height, width, slice_height, slice_width, overlap_ratio)
+    
+    tile_detections = []
+    for start in range(0, len(grid), batch_size):
+        batch_grid = grid[start:start + batch_size]
+        # YOLO (Ultralytics) espera BGR; a imagem vem em RGB
+        batch = [image_array[y1:y2, x1:x2, ::-1] for x1, y1, x2, y2 in batch_grid]
         
-        num_detections = len(result.object_prediction_list)
+        results = detection_model.model(
+            batch,
+            conf=detection_model.confidence_threshold,
+            imgsz=max(slice_height, slice_width),
+            device='cpu',
+            verbose=False
+        )
+        
+        # boxes.data: (n,6) = x1, y1, x2, y2, conf, cls em coordenadas do tile
+        for result, (x1, y1, _, _) in zip(results, batch_grid):
+            data = result.boxes.data.cpu().numpy().astype(np.float64)
+            data[:, 0:4:2] += x1
+            data[:, 1:4:2] += y1
+            tile_detections.append(data)
+    
+    data = np.concatenate(tile_detections) if tile_detections else np.zeros((0, 6))
+    
+    # Limita às dimensões da imagem e descarta caixas degeneradas (como o SAHI)
+    data[:, 0:4:2] = np.clip(data[:, 0:4:2], 0, width)
+    data[:, 1:4:2] = np.clip(data[:, 1:4:2], 0, height)
+    data = data[(data[:, 0] < data[:, 2]) & (data[:, 1] < data[:, 3])]
+    detections = Detections(data[:, :4], data[:, 4], data[:, 5].astype(np.int32), names)
+    
+    # Remove deteções duplicadas nas zonas de overlap
+    if len(grid) > 1 and len(detections.scores) > 1:
+        if postprocess == 'NMS':
+            detections = fast_nms(detections, match_threshold, match_metric)
+        else:
+            merge = POSTPROCESS_NAME_TO_CLASS[POSTPROCESS_TYPES[postprocess]](
+                match_threshold=match_threshold,
+                match_metric=match_metric,
+                class_agnostic=False
+            )
+            merged = merge(detections_to_predictions(detections, [height, width]))
+            detections = predictions_to_detections(merged, names)
+    
+    return detections
+
+
+def run_sahi_inference(detection_model, image_path, slice_height, slice_width, overlap_ratio,
+                       batch_size=DEFAULT_BATCH_SIZE, image=None, postprocess=DEFAULT_POSTPROCESS,
+                       match_metric=DEFAULT_MATCH_METRIC, match_threshold=DEFAULT_MATCH_THRESHOLD):
+    """Executa inferência YOLOv11 + SAHI com slicing (image: array já descodificado, opcional)"""
+    print(f"\n[2/3] Inferência SAHI em: {Path(image_path).name}")
+    print(f"  Slice size: {slice_width}x{slice_height}")
+    print(f"  Overlap: {overlap_ratio*100:.0f}%")
+    print(f"  Batch: {batch_size} tiles")
+    print(f"  Pós-processamento: {postprocess} ({match_metric} > {match_threshold})")
+    
+    try:
+        if image is None:
+            image = load_image(image_path)
+        
+        single_tile = fits_single_tile(image.shape[0], image.shape[1], slice_height, slice_width)
+        if single_tile:
+            print(f"  Imagem {image.shape[1]}x{image.shape[0]} cabe num tile: sem slicing")
+        
+        if batch_size > 1 or single_tile:
+            # Tiles agrupados em batch (menos chamadas ao modelo)
+            detections = get_batched_sliced_prediction(
+                detection_model,
+                image,
+                slice_height,
+                slice_width,
+                overlap_ratio,
+                batch_size,
+                postprocess,
+                match_metric,
+                match_threshold
+            )
+        else:
+            # SAHI sliced prediction (um tile de cada vez)
+            result = get_sliced_prediction(
+                image=image,
+                detection_model=detection_model,
+                slice_height=slice_height,
+                slice_width=slice_width,
+                overlap_height_ratio=overlap_ratio,
+                overlap_width_ratio=overlap_ratio,
+                perform_standard_pred=False,
+                postprocess_type=POSTPROCESS_TYPES[postprocess],
+                postprocess_match_metric=match_metric,
+                postprocess_match_threshold=match_threshold,
+                verbose=0
+            )
+            detections = predictions_to_detections(
+                result.object_prediction_list,
+                detection_model.model.names
+            )
+        
+        num_detections = len(detections.scores)
         
         print(f"✓ Inferência SAHI concluída")
         print(f"  Deteções: {num_detections}")
         
-        return result, num_detections
+        return detections, num_detections
         
     except Exception as e:
         print(f"✗ Erro durante inferência SAHI: {e}")
@@ -151,43 +591,207 @@ def run_sahi_inference(detection_model, image_path, slice_height, slice_width, o
 # ============================================================================
 
 
-def display_sahi_results(result, num_detections):
-    """Mostra deteções SAHI no terminal"""
-    print(f"\n[3/3] RESULTADOS:")
-    print("="*60)
+def display_sahi_results(detections, num_detections):
+    """Mostra deteções SAHI no terminal (uma só escrita no stdout)"""
+    lines = [f"\n[3/3] RESULTADOS:\n", "="*60 + "\n"]
     
     if num_detections == 0:
-        print("  Nenhuma deteção acima do threshold")
+        lines.append("  Nenhuma deteção acima do threshold\n")
     else:
-        print(f"  Total de deteções: {num_detections}\n")
+        lines.append(f"  Total de deteções: {num_detections}\n\n")
         
-        # Itera sobre cada deteção (ObjectPrediction do SAHI)
-        for i, pred in enumerate(result.object_prediction_list, 1):
-            class_name = pred.category.name
-            conf = pred.score.value
-            bbox = pred.bbox  # SAHI bbox format: minx, miny, maxx, maxy
+        # Converte os arrays para listas Python uma só vez e itera
+        for i, (box, conf, class_id) in enumerate(zip(
+            detections.boxes.tolist(), detections.scores.tolist(), detections.class_ids.tolist()
+        ), 1):
+            class_name = detections.names.get(class_id, str(class_id))
             
-            print(f"  [{i}] {class_name}")
-            print(f"      Confiança: {conf:.3f} ({conf*100:.1f}%)")
-            print(f"      BoundingBox: ({bbox.minx:.0f}, {bbox.miny:.0f}) → ({bbox.maxx:.0f}, {bbox.maxy:.0f})")
+            lines.append(
+                f"  [{i}] {class_name}\n"
+                f"      Confiança: {conf:.3f} ({conf*100:.1f}%)\n"
+                f"      BoundingBox: ({box[0]:.0f}, {box[1]:.0f}) → ({box[2]:.0f}, {box[3]:.0f})\n"
+            )
     
-    print("="*60)
+    lines.append("="*60 + "\n")
+    sys.stdout.write("".join(lines))
+
+
+def write_results_jsonl(jsonl_file, image_path, detections):
+    """Acrescenta as deteções de uma imagem ao ficheiro JSONL (uma linha por deteção)"""
+    image_name = Path(image_path).name
+    jsonl_file.write("".join(
+        json.dumps({
+            "image": image_name,
+            "class": detections.names.get(class_id, str(class_id)),
+            "conf": round(conf, 4),
+            "bbox": [round(v, 1) for v in box],
+        }) + "\n"
+        for box, conf, class_id in zip(
+            detections.boxes.tolist(), detections.scores.tolist(), detections.class_ids.tolist()
+        )
+    ))
 
 
 # ============================================================================
-# FUNÇÃO: VALIDAR FORMATOS DE IMAGEM 
+# FUNÇÃO: LISTAR IMAGENS DE UMA PASTA
 # ============================================================================
 
 
-def get_valid_images(path_list):
-    """Filtra apenas ficheiros de imagem válidos"""
-    valid = []
-    for p in path_list:
-        if p.suffix.lower() in SUPPORTED_FORMATS:
-            valid.append(p)
-        else:
-            print(f"⚠ Ignorado (formato não suportado): {p.name}")
-    return valid
+def list_images(dir_path):
+    """Lista imagens suportadas numa pasta (uma única passagem com scandir)"""
+    images = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            # Extensão direto do nome (sem criar Path/splitext por ficheiro)
+            name = entry.name
+            if (name[name.rfind('.'):].lower() in SUPPORTED_FORMATS
+                    and entry.is_file(follow_symlinks=False)):
+                images.append(Path(entry.path))
+    images.sort()
+    return images
+
+
+# ============================================================================
+# FUNÇÃO: PROCESSAR UMA IMAGEM
+# ============================================================================
+
+
+def process_image(detection_model, img_path, image, args, jsonl_file):
+    """Inferência SAHI + output de uma imagem; devolve nº de deteções (None se falhar)"""
+    detections, num_detections = run_sahi_inference(
+        detection_model, 
+        str(img_path), 
+        args.slice_size,  # slice_height
+        args.slice_size,  # slice_width
+        args.overlap,
+        args.batch,
+        image,
+        args.postprocess,
+        args.match_metric,
+        args.match_threshold
+    )
+    if detections is None:
+        return None
+    
+    # Mostra resultados
+    display_sahi_results(detections, num_detections)
+    if jsonl_file:
+        write_results_jsonl(jsonl_file, img_path, detections)
+    return num_detections
+
+
+# ============================================================================
+# FUNÇÃO: MODO SERVIÇO (VIGIAR PASTA)
+# ============================================================================
+
+
+def watch_directory(watch_dir, handle_image):
+    """Processa cada imagem nova que aparece na pasta até Ctrl+C; devolve (imagens, deteções)"""
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        print("ERRO: watchdog não instalado")
+        print("Execute: pip install watchdog")
+        return None
+    
+    # O observer corre noutra thread; a inferência fica na thread principal
+    new_files = queue.Queue()
+    # Criados sem escrita nem fecho (mv de fora): caminho -> último tamanho visto (-1 = por medir)
+    pending_files = {}
+    # Já enviados para a fila por tamanho estável: caminho -> instante (o fecho não os repete)
+    settled_files = {}
+    pending_lock = threading.Lock()
+    
+    class NewImageHandler(FileSystemEventHandler):
+        def on_created(self, event):
+            # mv vindo de fora da pasta vigiada só gera este evento: fica à espera
+            # de tamanho estável (cópias/escritas saem daqui no 1º on_modified)
+            if not event.is_directory:
+                with pending_lock:
+                    pending_files[event.src_path] = -1
+        
+        def on_modified(self, event):
+            # Está a ser escrito: é o on_closed que o envia, nunca o tamanho estável
+            # (uma pausa do escritor faria ler a imagem a meio)
+            if not event.is_directory:
+                with pending_lock:
+                    pending_files.pop(event.src_path, None)
+        
+        def on_closed(self, event):
+            # Ficheiro fechado após escrita (a imagem já está completa)
+            if not event.is_directory:
+                with pending_lock:
+                    pending_files.pop(event.src_path, None)
+                    if settled_files.pop(event.src_path, None) is not None:
+                        return
+                new_files.put(event.src_path)
+        
+        def on_moved(self, event):
+            # rename dentro da pasta vigiada (ex: escrita em .tmp e rename no fim)
+            if not event.is_directory:
+                with pending_lock:
+                    pending_files.pop(event.src_path, None)
+                new_files.put(event.dest_path)
+    
+    def queue_settled_files():
+        """Passa para a fila os ficheiros pendentes cujo tamanho não mudou desde a última verificação"""
+        now = time.monotonic()
+        with pending_lock:
+            for path, last_size in list(pending_files.items()):
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    del pending_files[path]  # apagado ou renomeado entretanto
+                    continue
+                if size > 0 and size == last_size:
+                    del pending_files[path]
+                    settled_files[path] = now
+                    new_files.put(path)
+                else:
+                    pending_files[path] = size
+            # Ficheiros movidos não têm fecho: esquece-os ao fim de um minuto
+            for path, settled_at in list(settled_files.items()):
+                if now - settled_at > 60:
+                    del settled_files[path]
+    
+    observer = Observer()
+    observer.schedule(NewImageHandler(), str(watch_dir), recursive=True)
+    observer.start()
+    print(f"\n✓ A vigiar: {watch_dir} (Ctrl+C para parar)")
+    
+    num_images = 0
+    total_detections = 0
+    next_settle_check = time.monotonic() + WATCH_SETTLE_SECONDS
+    try:
+        while True:
+            if time.monotonic() >= next_settle_check:
+                queue_settled_files()
+                next_settle_check = time.monotonic() + WATCH_SETTLE_SECONDS
+            
+            # Timeout curto para o Ctrl+C ser atendido mesmo sem imagens novas
+            try:
+                img_path = Path(new_files.get(timeout=WATCH_SETTLE_SECONDS))
+            except queue.Empty:
+                continue
+            if img_path.suffix.lower() not in SUPPORTED_FORMATS:
+                continue
+            
+            num_images += 1
+            print(f"\n{'='*60}")
+            print(f"[{num_images}] NOVA IMAGEM: {img_path.name}")
+            print('='*60)
+            
+            num_detections = handle_image(img_path)
+            if num_detections is not None:
+                total_detections += num_detections
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        observer.join()
+    
+    return num_images, total_detections
 
 
 # ============================================================================
@@ -205,6 +809,10 @@ def main():
         '--input-dir',
         help='Pasta com múltiplas imagens'
     )
+    parser.add_argument(
+        '--watch',
+        help='Modo serviço: vigia a pasta e processa cada imagem nova (modelo carregado uma vez)'
+    )
     parser.add_argument(
         '--model',
         default=DEFAULT_MODEL,
@@ -228,30 +836,73 @@ def main():
         default=DEFAULT_OVERLAP_RATIO,
         help=f'Overlap ratio entre tiles (default: {DEFAULT_OVERLAP_RATIO})'
     )
+    parser.add_argument(
+        '--postprocess',
+        choices=sorted(POSTPROCESS_TYPES),
+        default=DEFAULT_POSTPROCESS,
+        help=f'Junção de deteções entre tiles: NMS (rápido) ou NMM (default: {DEFAULT_POSTPROCESS})'
+    )
+    parser.add_argument(
+        '--match-metric',
+        choices=['IOU', 'IOS'],
+        default=DEFAULT_MATCH_METRIC,
+        help=f'Métrica de sobreposição para a junção (default: {DEFAULT_MATCH_METRIC})'
+    )
+    parser.add_argument(
+        '--match-threshold',
+        type=float,
+        default=DEFAULT_MATCH_THRESHOLD,
+        help=f'Threshold de sobreposição para a junção (default: {DEFAULT_MATCH_THRESHOLD})'
+    )
+    parser.add_argument(
+        '--export',
+        choices=sorted(EXPORT_FORMATS),
+        help='Exporta o modelo .pt para NCNN/ONNX e usa o modelo exportado'
+    )
+    parser.add_argument(
+        '--grayscale',
+        action='store_true',
+        help='Usa só a luminância da imagem (descodificação mais rápida; validar a precisão do modelo)'
+    )
+    parser.add_argument(
+        '--jsonl',
+        help='Grava as deteções neste ficheiro JSONL (acrescenta, uma linha por deteção)'
+    )
+    parser.add_argument(
+        '--batch',
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f'Tiles por forward pass do YOLO, 1 = sequencial (default: {DEFAULT_BATCH_SIZE})'
+    )
     
     args = parser.parse_args()
     
-    # Validação: precisa de --image OU --input-dir
-    if not args.image and not args.input_dir:
-        print("\n✗ Erro: Forneça --image ou --input-dir")
+    # range(0, n, batch) rebenta com batch <= 0 (erro de inferência em todas as imagens)
+    if args.batch < 1:
+        parser.error(f"--batch tem de ser pelo menos 1, recebido {args.batch}")
+    
+    # Validação: precisa de --image, --input-dir OU --watch
+    if not args.image and not args.input_dir and not args.watch:
+        print("\n✗ Erro: Forneça --image, --input-dir ou --watch")
         print("Exemplos:")
         print("  python3 yolo_test_pi.py --image test.jpg")
         print("  python3 yolo_test_pi.py --input-dir ./test_images/ --slice-size 640")
+        print("  python3 yolo_test_pi.py --watch ./captured_images/")
         return 1
     
     # Determina lista de imagens a processar
     images = []
-    if args.input_dir:
+    if args.watch:
+        if not Path(args.watch).is_dir():
+            print(f"\n✗ Pasta não encontrada: {args.watch}")
+            return 1
+    elif args.input_dir:
         dir_path = Path(args.input_dir)
         if not dir_path.exists():
             print(f"\n✗ Pasta não encontrada: {dir_path}")
             return 1
         
-        all_files = []
-        for fmt in SUPPORTED_FORMATS:
-            all_files.extend(dir_path.glob(f"*{fmt}"))
-        
-        images = get_valid_images(all_files)  
+        images = list_images(dir_path)
         
         if not images:
             print(f"\n✗ Nenhuma imagem válida encontrada em: {dir_path}")
@@ -270,40 +921,94 @@ def main():
         images = [img_path]
         print(f"✓ Imagem encontrada: {img_path.name}")
     
+    # PASSO 0 (opcional): Exporta para runtime otimizado
+    model_path = args.model
+    if args.export:
+        model_path = export_model(args.model, args.export, args.slice_size)
+        if model_path is None:
+            return 1
+    
+    # NCNN (Ultralytics) só processa 1 imagem por forward pass
+    if model_path.rstrip('/').endswith('_ncnn_model') and args.batch > 1:
+        print("⚠ NCNN não suporta batch, a usar --batch 1")
+        args.batch = 1
+    
+    configure_cpu_threads()
+    
     # PASSO 1: Carrega o modelo com SAHI (uma vez só)
-    detection_model = load_model_with_sahi(args.model, args.conf)
+    detection_model = load_model_with_sahi(model_path, args.conf)
     if detection_model is None:
         return 1
     
-    # PASSO 2 e 3: Processa todas as imagens com SAHI
-    total_detections = 0
-    for i, img_path in enumerate(images, 1):
-        print(f"\n{'='*60}")
-        print(f"[{i}/{len(images)}] PROCESSANDO: {img_path.name}")
-        print('='*60)
+    # 1º predict antes das imagens reais (o Ultralytics muda o nº de threads aqui)
+    warmup_model(detection_model, args.slice_size)
+    apply_inference_threads()
+    
+    jsonl_file = open(args.jsonl, 'a', buffering=65536, encoding='utf-8') if args.jsonl else None
+    
+    # MODO SERVIÇO: modelo aquecido uma vez, processa imagens à medida que chegam
+    # (descodificação na thread principal: não há imagem seguinte para adiantar)
+    if args.watch:
+        def handle_image(img_path):
+            try:
+                image = load_image(img_path, args.grayscale)
+            except Exception as e:
+                print(f"✗ Erro ao ler imagem: {e}")
+                return None
+            num_detections = process_image(detection_model, img_path, image, args, jsonl_file)
+            if jsonl_file:
+                jsonl_file.flush()
+            return num_detections
         
-        # Executa inferência SAHI
-        result, num_detections = run_sahi_inference(
-            detection_model, 
-            str(img_path), 
-            args.slice_size,  # slice_height
-            args.slice_size,  # slice_width
-            args.overlap
-        )
-        if result is None:
-            continue
+        watch_result = watch_directory(args.watch, handle_image)
+        if jsonl_file:
+            jsonl_file.close()
+        if watch_result is None:
+            return 1
+        num_images, total_detections = watch_result
+    
+    else:
+        # PASSO 2 e 3: Processa todas as imagens com SAHI
+        # Descodifica a imagem seguinte numa thread enquanto o YOLO processa a atual
+        num_images = len(images)
+        total_detections = 0
+        with ThreadPoolExecutor(max_workers=1, initializer=pin_decoder_thread) as decoder:
+            next_image = decoder.submit(load_image, images[0], args.grayscale)
+            
+            for i, img_path in enumerate(images, 1):
+                print(f"\n{'='*60}")
+                print(f"[{i}/{len(images)}] PROCESSANDO: {img_path.name}")
+                print('='*60)
+                
+                current_image = next_image
+                if i < len(images):
+                    next_image = decoder.submit(load_image, images[i], args.grayscale)
+                # A imagem a seguir à que está a ser descodificada já vai sendo lida do disco
+                if i + 1 < len(images):
+                    readahead_file(images[i + 1])
+                
+                try:
+                    image = current_image.result()
+                except Exception as e:
+                    print(f"✗ Erro ao ler imagem: {e}")
+                    continue
+                
+                num_detections = process_image(detection_model, img_path, image, args, jsonl_file)
+                if num_detections is not None:
+                    total_detections += num_detections
         
-        # Mostra resultados
-        display_sahi_results(result, num_detections)
-        total_detections += num_detections
+        if jsonl_file:
+            jsonl_file.close()
     
     # Resumo final
     print("\n" + "="*60)
     print("RESUMO FINAL")
     print("="*60)
-    print(f"  Imagens processadas: {len(images)}")
+    print(f"  Imagens processadas: {num_images}")
     print(f"  Total de deteções: {total_detections}")
-    print(f"  Configuração SAHI: {args.slice_size}x{args.slice_size} (overlap {args.overlap*100:.0f}%)")
+    if args.jsonl:
+        print(f"  Deteções gravadas em: {args.jsonl}")
+    print(f"  Configuração SAHI: {args.slice_size}x{args.slice_size} (overlap {args.overlap*100:.0f}%, batch {args.batch})")
     print("\n✅ YOLOv11 + SAHI FUNCIONAL NO RASPBERRY PI 5!")
     
     return 0
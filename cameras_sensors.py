@@ -0,0 +1,33 @@
+"""
+cameras_sensors.py - Tabela de sensores partilhada pelos scripts de câmera
+================================================================================
+PROPÓSITO: Fonte única para resolução máxima e descrição de cada sensor
+USADO POR: setup_cameras.py, capture_test.py
+
+O nome do modelo (ex: 'imx708_wide', reportado pelo libcamera) é comparado por
+substring com as chaves, pela ordem da tabela.
+"""
+
+from functools import lru_cache
+
+# Sensor -> (largura, altura, descrição) da resolução máxima
+SENSOR_TABLE = {
+    'ov64a40': (9248, 6944, '64MP (Arducam OV64A40)'),
+    'imx519': (4656, 3496, '16MP (Arducam IMX519)'),
+    'imx708': (4608, 2592, '12MP (Camera Module 3)'),
+    'imx477': (4056, 3040, '12.3MP (HQ Camera)'),
+    'imx500': (4056, 3040, '12.3MP (AI Camera)'),
+    'imx219': (3280, 2464, '8MP (Camera Module 2)'),
+    'ov5647': (2592, 1944, '5MP (Camera Module 1)'),
+    'imx296': (1456, 1088, '1.6MP (Global Shutter Camera)'),
+}
+
+# Sensor não reconhecido: assume Full HD
+FALLBACK_SENSOR = (1920, 1080, 'Desconhecido (Full HD)')
+
+@lru_cache(maxsize=None)
+def lookup_sensor(model):
+    """Devolve (largura, altura, descrição) do sensor a partir do nome do modelo"""
+    model_lower = model.lower()
+    return next(((w, h, label) for key, (w, h, label) in SENSOR_TABLE.items() if key in model_lower),
+                FALLBACK_SENSOR)
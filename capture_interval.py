@@ -16,11 +16,12 @@ EXECUÇÃO: python3 capture_interval.py
 Pressione Ctrl+C para parar de forma limpa
 """
 
+import os
 import sys
 import time
 import signal
+import threading
 from pathlib import Path
-from datetime import datetime
 
 try:
     from picamera2 import Picamera2
@@ -46,6 +47,12 @@ INTERVAL_SECONDS = 300  # 300s = 5 minutos (recomendado para armadilhas)
 RESOLUTION = (4608, 2592)  # Full para Pi Camera V3 (12MP)
 # Alternativa para testes rápidos: (1920, 1080)
 
+# --- FORMATO DO BUFFER ---
+CAPTURE_FORMAT = "YUV420"  # 1.5 bytes/pixel (vs 3-4 em RGB), JPEG codificado direto dos planos YUV
+# O Pi 5 não tem encoder JPEG em hardware: a codificação é sempre na CPU
+# (simplejpeg/libjpeg-turbo, direto dos planos YUV); a qualidade é o único ajuste
+JPEG_QUALITY = 90
+
 # --- FOCO MANUAL ---
 USE_MANUAL_FOCUS = True
 LENS_POSITION = 7.5  # Ajustar conforme testado no capture_test.py
@@ -53,17 +60,28 @@ LENS_POSITION = 7.5  # Ajustar conforme testado no capture_test.py
 
 # --- ZOOM DIGITAL (ROI) ---
 USE_ZOOM = False  # Mudar para True se quiser zoom
-ZOOM_FACTOR = 4.0  # 2.0x, 4.0x, 8.0x
+ZOOM_FACTOR = 4.0  # 1.5x, 2.0x, 3.0x, 4.0x, 6.0x, 8.0x
+# Zoom discreto: o fator é arredondado ao nível mais próximo, cujo ROI alinhado
+# é pré-calculado uma vez (crop estável entre capturas, sem re-afinação do ISP)
+ZOOM_LEVELS = (1.0, 1.5, 2.0, 3.0, 4.0, 6.0, 8.0)
+ZOOM_FACTOR = min(ZOOM_LEVELS, key=lambda z: abs(z - ZOOM_FACTOR))
+
+# --- GRAVAÇÃO EM BACKGROUND ---
+MAX_PENDING_SAVES = 2  # Máximo de JPEGs a codificar/gravar em paralelo (SD lento)
+
+# --- CPU ---
+CAPTURE_CORES = {0}  # Core 0 para a câmera; SAHI.py usa os cores 1-3 para inferência
 
 # Controlo interno
 running = True
+save_slots = threading.Semaphore(MAX_PENDING_SAVES)
 
 print("="*60)
 print("CAPTURA INTERVALADA - CuliTrap")
 print("="*60)
 print(f"Câmera ID: {CAMERA_ID}")
 print(f"Intervalo: {INTERVAL_SECONDS}s ({INTERVAL_SECONDS/60:.1f} minutos)")
-print(f"Resolução: {RESOLUTION}")
+print(f"Resolução: {RESOLUTION} ({CAPTURE_FORMAT})")
 print(f"Foco Manual: {'Ativado' if USE_MANUAL_FOCUS else 'Desativado'}")
 if USE_MANUAL_FOCUS:
     print(f"  Posição: {LENS_POSITION}")
@@ -87,16 +105,21 @@ print(f"✓ Pasta criada: {cam_dir}")
 # CALCULAR ROI PARA ZOOM
 # ============================================================================
 
-def calculate_roi(zoom_factor):
-    """Calcula ROI para zoom centralizado"""
+def calculate_roi(zoom_factor, sensor_w, sensor_h):
+    """Calcula ROI (x, y, width, height) em pixels do sensor para zoom centralizado"""
     if zoom_factor <= 1.0:
         return None
-    width = 1.0 / zoom_factor
-    height = 1.0 / zoom_factor
-    x = (1.0 - width) / 2.0
-    y = (1.0 - height) / 2.0
+    # Largura múltipla de 32 e altura de 16 (stride do ISP), origem em pixel par:
+    # evita o arredondamento/resample extra que o ISP faz a um crop desalinhado
+    width = (int(sensor_w / zoom_factor) // 32) * 32
+    height = (int(sensor_h / zoom_factor) // 16) * 16
+    x = ((sensor_w - width) // 2) & ~1
+    y = ((sensor_h - height) // 2) & ~1
     return (x, y, width, height)
 
+# ROI de cada nível de ZOOM_LEVELS, preenchido em init_camera quando se conhece o sensor
+ROI_TABLE = {}
+
 # ============================================================================
 # INICIALIZAR CÂMERA
 # ============================================================================
@@ -110,12 +133,21 @@ def init_camera():
     
     try:
         camera = Picamera2(CAMERA_ID)
+        sensor_w, sensor_h = camera.camera_properties["PixelArraySize"]
+        ROI_TABLE.update({z: calculate_roi(z, sensor_w, sensor_h) for z in ZOOM_LEVELS})
         
         # Configuração
+        # Sem streams de preview/encode: só os buffers full-res ocupam CMA
+        # Um buffer por gravação pendente + 1 para a câmera continuar a receber frames
+        # (cada save_request segura o seu buffer até o JPEG estar gravado)
         config = camera.create_still_configuration(
-            main={"size": RESOLUTION}
+            main={"size": RESOLUTION, "format": CAPTURE_FORMAT},
+            buffer_count=MAX_PENDING_SAVES + 1,
+            display=None,
+            encode=None
         )
         camera.configure(config)
+        camera.options["quality"] = JPEG_QUALITY
         camera.start()
         
         print(f"  ✓ Câmera {CAMERA_ID} iniciada")
@@ -135,7 +167,7 @@ def init_camera():
         
         # --- APLICAR ZOOM ---
         if USE_ZOOM:
-            roi = calculate_roi(ZOOM_FACTOR)
+            roi = ROI_TABLE[ZOOM_FACTOR]
             if roi:
                 camera.set_controls({"ScalerCrop": roi})
                 print(f"  ✓ Zoom {ZOOM_FACTOR}x: ROI = {roi}")
@@ -150,21 +182,44 @@ def init_camera():
 # CAPTURA
 # ============================================================================
 
-def capture_image():
-    """Captura e guarda uma imagem"""
+def save_request(request, filename, stamp):
+    """Codifica e grava o JPEG em background, liberta o buffer da câmera"""
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = cam_dir / f"{timestamp}.jpg"
-        
-        camera.capture_file(str(filename))
+        request.save("main", str(filename), format="jpeg")
         
         size_kb = filename.stat().st_size / 1024
-        print(f"  [{datetime.now().strftime('%H:%M:%S')}] ✓ {filename.name} ({size_kb:.1f} KB)")
-        return True
+        # stamp = "AAAAMMDD_HHMMSS" da captura
+        print(f"  [{stamp[9:11]}:{stamp[11:13]}:{stamp[13:15]}] ✓ {filename.name} ({size_kb:.1f} KB)")
+        
+    except Exception as e:
+        print(f"  ✗ Erro ao gravar {filename.name}: {e}")
+    finally:
+        request.release()
+        save_slots.release()
+
+def capture_image(capture_count):
+    """Captura uma imagem (a gravação corre numa thread à parte)"""
+    # Bloqueia se já houver MAX_PENDING_SAVES gravações pendentes
+    save_slots.acquire()
+    try:
+        # Contador no nome evita colisões com intervalos abaixo de 1s
+        stamp = time.strftime("%Y%m%d_%H%M%S")
+        filename = cam_dir / f"{stamp}_{capture_count:06d}.jpg"
+        
+        request = camera.capture_request()
         
     except Exception as e:
+        save_slots.release()
         print(f"  ✗ Erro ao capturar: {e}")
         return False
+    
+    # JPEG encode + escrita no SD em paralelo com o intervalo de espera
+    threading.Thread(
+        target=save_request,
+        args=(request, filename, stamp),
+        daemon=True
+    ).start()
+    return True
 
 # ============================================================================
 # CLEANUP
@@ -173,6 +228,9 @@ def capture_image():
 def cleanup():
     """Para e fecha a câmera"""
     print("\n\n[CLEANUP] A parar câmera...")
+    # Aguarda que as gravações pendentes terminem
+    for _ in range(MAX_PENDING_SAVES):
+        save_slots.acquire()
     if camera:
         try:
             camera.stop()
@@ -195,6 +253,10 @@ signal.signal(signal.SIGINT, signal_handler)
 def main():
     global running
     
+    # Fixa a captura no core 0 (não compete com a inferência)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, CAPTURE_CORES)
+    
     # Inicializa
     if not init_camera():
         print("\n✗ Falha ao inicializar. A terminar.")
@@ -210,7 +272,7 @@ def main():
         while running:
             capture_count += 1
             print(f"[Captura #{capture_count}]")
-            capture_image()
+            capture_image(capture_count)
             
             # Aguarda próximo intervalo
             time.sleep(INTERVAL_SECONDS)
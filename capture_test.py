@@ -10,16 +10,22 @@ FUNCIONALIDADE:
 1. Testa uma câmera (configurável via CAMERA_ID)
 2. Suporta foco manual (essencial para evitar focar no background)
 3. Suporta zoom digital (ROI) para ampliar insetos
-4. Aguarda estabilização auto-exposição/white balance
-5. Guarda imagens com timestamp em ./camera_test_images/
+4. Aguarda estabilização auto-exposição/white balance (partindo dos valores
+   da última captura, guardados em camN_last.json, converge mais depressa)
+5. Guarda imagens com timestamp (e .json com os controlos) em ./camera_test_images/
 
-EXECUÇÃO: python3 capture_test.py
+EXECUÇÃO: python3 capture_test.py [--count N] [--fresh]
 """
 
 import sys
 import os
+import io
+import json
+import argparse
+import time
 from pathlib import Path
-from datetime import datetime
+
+from cameras_sensors import lookup_sensor
 
 # Tenta importar Picamera2 
 try:
@@ -41,6 +47,12 @@ CAMERA_ID = 0
 RESOLUTION = (4608, 2592)  # Full HD para V3
 # Alternativa rápida para testes: (1920, 1080)
 
+# --- FORMATO DO BUFFER ---
+CAPTURE_FORMAT = "YUV420"  # 1.5 bytes/pixel (vs 3-4 em RGB), JPEG codificado direto dos planos YUV
+# O Pi 5 não tem encoder JPEG em hardware: a codificação é sempre na CPU
+# (simplejpeg/libjpeg-turbo, direto dos planos YUV); a qualidade é o único ajuste
+JPEG_QUALITY = 90
+
 # --- FOCO MANUAL ---
 USE_MANUAL_FOCUS = True  # Desativar se quiser autofocus
 LENS_POSITION = 7.5  # Valor de foco (ajustar conforme testado)
@@ -48,8 +60,27 @@ LENS_POSITION = 7.5  # Valor de foco (ajustar conforme testado)
 
 # --- ZOOM DIGITAL (ROI) ---
 USE_ZOOM = False  # Mudar para True se quiser zoom
-ZOOM_FACTOR = 4.0  # 2.0x, 4.0x, 8.0x
-# O zoom é calculado automaticamente com base no fator
+ZOOM_FACTOR = 4.0  # 1.5x, 2.0x, 3.0x, 4.0x, 6.0x, 8.0x
+# Zoom discreto: o fator é arredondado ao nível mais próximo, cujo ROI alinhado
+# é pré-calculado uma vez (crop estável entre capturas, sem re-afinação do ISP)
+ZOOM_LEVELS = (1.0, 1.5, 2.0, 3.0, 4.0, 6.0, 8.0)
+ZOOM_FACTOR = min(ZOOM_LEVELS, key=lambda z: abs(z - ZOOM_FACTOR))
+
+# --- MODO BURST (--count N) ---
+BURST_BUFFERS = 3  # Buffers da câmera quando se capturam várias fotos seguidas
+
+# --- ESTABILIZAÇÃO ---
+SETTLE_TIMEOUT = 3.0  # Máximo (s) a aguardar pela convergência AE/AWB
+SEEDED_SETTLE_TIMEOUT = 1.0  # Idem, a partir dos valores da última captura
+CONTROL_LATENCY_FRAMES = 3  # Frames até um set_controls fazer efeito no sensor
+LENS_TIMEOUT = 1.0  # Máximo (s) a aguardar que a lente chegue à posição
+LENS_TOLERANCE = 0.1  # Diferença aceitável na LensPosition reportada
+
+# --- VALORES DA ÚLTIMA CAPTURA ---
+# Exposição/ganhos guardados no .json de cada foto; no arranque seguinte com o
+# mesmo sensor são o ponto de partida do AE/AWB (que volta a medir a cena)
+SEED_KEYS = ("ExposureTime", "AnalogueGain", "ColourGains")
+SIDECAR_KEYS = SEED_KEYS + ("LensPosition", "ScalerCrop")
 
 # Pasta onde as imagens de teste vão ser guardadas
 OUTPUT_DIR = Path("./camera_test_images")
@@ -58,7 +89,7 @@ print("="*60)
 print("TESTE DE CAPTURA - Raspberry Pi Camera")
 print("="*60)
 print(f"Câmera ID: {CAMERA_ID}")
-print(f"Resolução: {RESOLUTION}")
+print(f"Resolução: {RESOLUTION} ({CAPTURE_FORMAT})")
 print(f"Foco Manual: {'Ativado' if USE_MANUAL_FOCUS else 'Desativado'}")
 if USE_MANUAL_FOCUS:
     print(f"  Posição da Lente: {LENS_POSITION}")
@@ -72,55 +103,185 @@ print("="*60)
 # ============================================================================
 
 OUTPUT_DIR.mkdir(exist_ok=True)
-print(f"\n✓ Pasta de output: {OUTPUT_DIR.absolute()}")
+# Caminho absoluto resolvido uma só vez (reutilizado em cada captura)
+OUTPUT_DIR_ABS = OUTPUT_DIR.resolve()
+print(f"\n✓ Pasta de output: {OUTPUT_DIR_ABS}")
+
+# Controlos da última captura desta câmera (ver SEED_KEYS)
+LAST_SETTINGS_FILE = OUTPUT_DIR_ABS / f"cam{CAMERA_ID}_last.json"
 
 # ============================================================================
 # CALCULAR ROI PARA ZOOM
 # ============================================================================
 
-def calculate_roi(zoom_factor):
-    """Calcula ROI (x, y, width, height) para zoom centralizado"""
+def calculate_roi(zoom_factor, sensor_w, sensor_h):
+    """Calcula ROI (x, y, width, height) em pixels do sensor para zoom centralizado"""
     if zoom_factor <= 1.0:
         return None
     
-    # ROI é fração do sensor (valores de 0.0 a 1.0)
-    width = 1.0 / zoom_factor
-    height = 1.0 / zoom_factor
-    x = (1.0 - width) / 2.0
-    y = (1.0 - height) / 2.0
+    # Largura múltipla de 32 e altura de 16 (stride do ISP), origem em pixel par:
+    # evita o arredondamento/resample extra que o ISP faz a um crop desalinhado
+    width = (int(sensor_w / zoom_factor) // 32) * 32
+    height = (int(sensor_h / zoom_factor) // 16) * 16
+    x = ((sensor_w - width) // 2) & ~1
+    y = ((sensor_h - height) // 2) & ~1
     
     return (x, y, width, height)
 
+# ROI de cada nível de ZOOM_LEVELS, preenchido quando se conhece o sensor
+ROI_TABLE = {}
+
+# ============================================================================
+# GRAVAR JPEG SEM ENCHER A PAGE CACHE
+# ============================================================================
+
+def write_jpeg(filename, data):
+    """Grava o JPEG já codificado e liberta as páginas da cache do cartão SD"""
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        # fdatasync primeiro: DONTNEED só descarta páginas já escritas no cartão
+        os.fdatasync(fd)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+# ============================================================================
+# METADADOS DA CAPTURA (.json AO LADO DO JPEG)
+# ============================================================================
+
+def capture_settings(metadata, model):
+    """Extrai da metadata da captura os controlos a guardar no .json"""
+    settings = {key: metadata[key] for key in SIDECAR_KEYS if key in metadata}
+    settings["Model"] = model
+    return settings
+
+def write_settings(filename, settings):
+    """Grava os controlos da captura em JSON"""
+    with open(filename, "w") as f:
+        json.dump(settings, f, indent=2)
+
+def load_last_controls(model):
+    """Devolve exposição/ganhos da última captura deste sensor (None se não houver)"""
+    try:
+        with open(LAST_SETTINGS_FILE) as f:
+            last = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if last.get("Model") != model:
+        return None
+    seed = {key: last[key] for key in SEED_KEYS if key in last}
+    if "ColourGains" in seed:
+        seed["ColourGains"] = tuple(seed["ColourGains"])
+    return seed or None
+
+# ============================================================================
+# INSTÂNCIAS PICAMERA2 (UMA POR CÂMERA, REUTILIZADA)
+# ============================================================================
+
+# Cada Picamera2() enumera as câmeras no libcamera (centenas de ms): abre uma vez
+_picam_cache = {}
+
+def get_picam(camera_id):
+    """Devolve a instância Picamera2 da câmera, criada só na primeira chamada"""
+    if camera_id not in _picam_cache:
+        _picam_cache[camera_id] = Picamera2(camera_id)
+    return _picam_cache[camera_id]
+
+def close_cameras():
+    """Fecha todas as câmeras abertas com get_picam"""
+    for picam in _picam_cache.values():
+        try:
+            picam.close()
+        except Exception:
+            pass
+    _picam_cache.clear()
+
+# ============================================================================
+# AGUARDAR ESTABILIZAÇÃO (METADATA EM VEZ DE SLEEP FIXO)
+# ============================================================================
+
+def wait_for_convergence(picam, timeout=SETTLE_TIMEOUT):
+    """Aguarda AE/AWB convergirem; devolve o tempo que demorou (None se timeout)"""
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        # capture_metadata bloqueia até ao próximo frame (não precisa de sleep)
+        md = picam.capture_metadata()
+        # Sensores que não reportam o estado não bloqueiam a captura
+        if md.get("AeLocked", True) and md.get("AwbLocked", True):
+            return time.monotonic() - start
+    return None
+
+def wait_for_lens(picam, position, timeout=LENS_TIMEOUT):
+    """Aguarda a lente chegar à posição pedida; devolve o tempo (None se timeout)"""
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        md = picam.capture_metadata()
+        if abs(md.get("LensPosition", position) - position) < LENS_TOLERANCE:
+            return time.monotonic() - start
+    return None
+
 # ============================================================================
 # TESTAR CÂMERA
 # ============================================================================
 
-def test_camera():
-    """Captura 1 foto de teste"""
+def test_camera(count=1, fresh=False):
+    """Captura `count` fotos de teste com a câmera sempre a correr"""
     
     print(f"\n[CÂMERA {CAMERA_ID}] A inicializar...")
     
     try:
-        # Cria objeto Picamera2
-        picam = Picamera2(CAMERA_ID)
+        # Obtém objeto Picamera2 (reutilizado se já estiver aberto)
+        picam = get_picam(CAMERA_ID)
         
         # Obtém informação da câmera
         camera_info = picam.camera_properties
-        print(f"  Modelo: {camera_info.get('Model', 'Desconhecido')}")
+        model = camera_info.get('Model', 'Desconhecido')
+        sensor_w, sensor_h, sensor_label = lookup_sensor(model)
+        print(f"  Modelo: {model} - {sensor_label}")
+        if RESOLUTION[0] > sensor_w or RESOLUTION[1] > sensor_h:
+            print(f"  ⚠ Resolução {RESOLUTION} acima do máximo do sensor ({sensor_w}x{sensor_h})")
         
-        # Configura para captura de alta qualidade
+        # Configura para captura de alta qualidade, sem streams de preview/encode
+        # Foto única: 1 buffer (só um full-res em CMA). Burst: BURST_BUFFERS para
+        # o sensor não parar à espera do buffer enquanto o anterior é codificado
+        # (custa ~18 MB de CMA por buffer extra a 12MP em YUV420)
+        seed = None if fresh else load_last_controls(model)
         config = picam.create_still_configuration(
-            main={"size": RESOLUTION}
+            main={"size": RESOLUTION, "format": CAPTURE_FORMAT},
+            buffer_count=BURST_BUFFERS if count > 1 else 1,
+            display=None,
+            encode=None,
+            controls=seed or {}
         )
         picam.configure(config)
+        picam.options["quality"] = JPEG_QUALITY
         
         # Inicia câmera
         picam.start()
-        print(f"  Câmera iniciada, a aguardar estabilização (2s)...")
         
-        # Aguarda estabilização
-        import time
-        time.sleep(2)
+        if seed:
+            # Valores fixos desligam o AE/AWB: só servem para o 1º frame, depois
+            # volta a medir a partir deles (a luz pode ter mudado desde a última vez)
+            print(f"  Câmera iniciada com os valores de {LAST_SETTINGS_FILE.name}: {seed}")
+            picam.set_controls({"AeEnable": True, "AwbEnable": True})
+            # Frames ainda com os valores fixos reportam AE/AWB "locked": descartados
+            for _ in range(CONTROL_LATENCY_FRAMES):
+                picam.capture_metadata()
+            settle_timeout = SEEDED_SETTLE_TIMEOUT
+        else:
+            print(f"  Câmera iniciada, a aguardar estabilização AE/AWB...")
+            settle_timeout = SETTLE_TIMEOUT
+        
+        # Aguarda estabilização (termina assim que AE/AWB convergem)
+        settle_time = wait_for_convergence(picam, settle_timeout)
+        if settle_time is None:
+            print(f"  ⚠ AE/AWB não convergiu em {settle_timeout}s, a continuar")
+        else:
+            print(f"  ✓ AE/AWB estável em {settle_time:.2f}s")
         
         # --- APLICAR FOCO MANUAL ---
         if USE_MANUAL_FOCUS:
@@ -129,37 +290,66 @@ def test_camera():
                 "LensPosition": LENS_POSITION
             })
             print(f"  ✓ Foco manual aplicado: {LENS_POSITION}")
-            time.sleep(1)  # Aguarda lente mover
+            # Aguarda lente mover
+            if wait_for_lens(picam, LENS_POSITION) is None:
+                print(f"  ⚠ Lente não confirmou a posição em {LENS_TIMEOUT}s")
         
         # --- APLICAR ZOOM (se ativado) ---
         if USE_ZOOM:
-            roi = calculate_roi(ZOOM_FACTOR)
+            if not ROI_TABLE:
+                sensor_w, sensor_h = camera_info["PixelArraySize"]
+                ROI_TABLE.update({z: calculate_roi(z, sensor_w, sensor_h) for z in ZOOM_LEVELS})
+            roi = ROI_TABLE[ZOOM_FACTOR]
             if roi:
                 picam.set_controls({"ScalerCrop": roi})
                 print(f"  ✓ Zoom {ZOOM_FACTOR}x aplicado: ROI = {roi}")
         
-        # Nome do ficheiro com timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Nome do ficheiro com timestamp (sufixo _NNN em modo burst)
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
         focus_label = f"focus{LENS_POSITION}" if USE_MANUAL_FOCUS else "autofocus"
         zoom_label = f"zoom{ZOOM_FACTOR}x" if USE_ZOOM else "nozoom"
-        filename = OUTPUT_DIR / f"cam{CAMERA_ID}_test_{timestamp}_{focus_label}_{zoom_label}.jpg"
+        prefix = f"cam{CAMERA_ID}_test_{timestamp}_{focus_label}_{zoom_label}"
         
-        # Captura imagem
-        print(f"  A capturar para: {filename.name}")
-        picam.capture_file(str(filename))
+        # Buffer JPEG único para todo o burst: cada captura escreve por cima desde o
+        # início e só corta a cauda no fim (truncate(0) libertaria a memória)
+        jpeg = io.BytesIO()
         
-        # Para a câmera
-        picam.stop()
-        picam.close()
-        
-        # Verifica se ficheiro foi criado
-        if filename.exists():
-            size_mb = filename.stat().st_size / (1024*1024)
-            print(f"  ✓ Sucesso! Tamanho: {size_mb:.2f} MB")
-            return True
-        else:
-            print(f"  ✗ Erro: ficheiro não foi criado")
+        # Pipeline fica a correr entre capturas: start/stop uma só vez por teste
+        try:
+            for i in range(count):
+                suffix = f"_{i:03d}" if count > 1 else ""
+                filename = OUTPUT_DIR_ABS / f"{prefix}{suffix}.jpg"
+                print(f"  A capturar para: {filename.name}")
+                
+                # Codifica para memória (request libertado mesmo se falhar) e
+                # só depois grava, com o buffer da câmera já devolvido
+                jpeg.seek(0)
+                request = picam.capture_request()
+                try:
+                    request.save("main", jpeg, format="jpeg")
+                    settings = capture_settings(request.get_metadata(), model)
+                finally:
+                    request.release()
+                jpeg.truncate()
+                
+                # A vista do buffer tem de ser libertada antes da próxima escrita
+                with jpeg.getbuffer() as data:
+                    write_jpeg(filename, data)
+                    size_mb = data.nbytes / (1024*1024)
+                write_settings(filename.with_suffix(".json"), settings)
+                
+                print(f"  ✓ Sucesso! Tamanho: {size_mb:.2f} MB")
+            
+            # Valores da última foto servem de ponto de partida na próxima execução
+            write_settings(LAST_SETTINGS_FILE, settings)
+        except OSError as e:
+            print(f"  ✗ Erro ao gravar ficheiro: {e}")
             return False
+        finally:
+            # Para a câmera (fecha no fim, em close_cameras)
+            picam.stop()
+        
+        return True
         
     except Exception as e:
         print(f"  ✗ ERRO: {e}")
@@ -170,12 +360,24 @@ def test_camera():
 # ============================================================================
 
 def main():
-    success = test_camera()
+    parser = argparse.ArgumentParser(description="Teste de captura da Raspberry Pi Camera")
+    parser.add_argument("--count", type=int, default=1,
+                        help="Número de fotos a capturar sem parar a câmera (default: 1)")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Ignora os valores da última captura (AE/AWB converge do zero)")
+    args = parser.parse_args()
+    if args.count < 1:
+        parser.error("--count tem de ser >= 1")
+    
+    try:
+        success = test_camera(args.count, args.fresh)
+    finally:
+        close_cameras()
     
     print("\n" + "="*60)
     if success:
         print("✓ TESTE COMPLETO")
-        print(f"Verifique a imagem em: {OUTPUT_DIR.absolute()}")
+        print(f"Verifique a imagem em: {OUTPUT_DIR_ABS}")
         return 0
     else:
         print("✗ TESTE FALHOU")
@@ -13,8 +13,17 @@ FUNCIONALIDADE:
 EXECUÇÃO: python3 setup_cameras.py
 """
 
+import io
+import re
 import sys
+import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from cameras_sensors import lookup_sensor
+
+# Linha de câmera no output do --list-cameras (formato: "0 : imx708 [4608x2592 ...]")
+CAMERA_LINE_RE = re.compile(r'^\s*(\d+)\s*:\s*(\w+)', re.MULTILINE)
 
 print("="*60)
 print("SETUP E VALIDAÇÃO DE CÂMERAS - Raspberry Pi 5 (UNIVERSAL)")
@@ -27,11 +36,11 @@ print("="*60)
 def check_libcamera():
     print("\n[1/3] A verificar instalação de ferramentas de câmera...")
     
-    # Tenta encontrar rpicam-hello ou libcamera-hello 
+    # Tenta encontrar rpicam-hello ou libcamera-hello (procura no PATH, sem subprocessos)
     cmd = None
-    if subprocess.run(['which', 'rpicam-hello'], capture_output=True).returncode == 0:
+    if shutil.which('rpicam-hello'):
         cmd = 'rpicam-hello'
-    elif subprocess.run(['which', 'libcamera-hello'], capture_output=True).returncode == 0:
+    elif shutil.which('libcamera-hello'):
         cmd = 'libcamera-hello'
 
     if cmd:
@@ -46,9 +55,9 @@ def check_libcamera():
 # PASSO 2: Listar câmeras detetadas pelo sistema
 # ============================================================================
 
-def list_cameras(cmd_tool):
+def list_cameras(cmd_tool, out=sys.stdout):
     if not cmd_tool: return 0
-    print("\n[2/3] A listar câmeras detetadas...")
+    print("\n[2/3] A listar câmeras detetadas...", file=out)
     
     try:
         result = subprocess.run(
@@ -60,60 +69,73 @@ def list_cameras(cmd_tool):
         
         output = result.stdout + result.stderr
         
-        if "Available cameras" in output:
-            print("✓ Câmeras encontradas:\n")
-            print(output)
-            
-            # Conta linhas que começam com número seguido de " : " (formato: "0 : imx708")
-            import re
-            camera_lines = re.findall(r'^\s*\d+\s*:\s*\w+', output, re.MULTILINE)
-            num_cameras = len(camera_lines)
+        # Uma só passagem pelo output com a regex pré-compilada; o texto
+        # "Available cameras" só é procurado se nenhuma linha de câmera aparecer
+        cameras = [(int(m.group(1)), m.group(2).lower()) for m in CAMERA_LINE_RE.finditer(output)]
+        
+        if cameras or "Available cameras" in output:
+            print("✓ Câmeras encontradas:\n", file=out)
+            print(output, file=out)
             
-            if num_cameras == 0:
-                # Fallback: se não encontrou o padrão, assume 1 se "Available cameras" apareceu
-                num_cameras = 1
+            for idx, sensor in cameras:
+                width, height, label = lookup_sensor(sensor)
+                print(f"  Câmera {idx}: {sensor} - {label}, máx. {width}x{height}", file=out)
             
-            return num_cameras
+            # Fallback: se não encontrou o padrão, assume 1 se "Available cameras" apareceu
+            return len(cameras) or 1
         else:
-            print("✗ Nenhuma câmera detetada pelo sistema.")
-            print("  Verifique se o cabo está ligado corretamente (dentes para o lado certo).")
+            print("✗ Nenhuma câmera detetada pelo sistema.", file=out)
+            print("  Verifique se o cabo está ligado corretamente (dentes para o lado certo).", file=out)
             return 0
             
     except Exception as e:
-        print(f"✗ Erro ao listar câmeras: {e}")
+        print(f"✗ Erro ao listar câmeras: {e}", file=out)
         return 0
 
 # ============================================================================
 # PASSO 3: Verificar se Picamera2 (Python) funciona
 # ============================================================================
 
-def check_picamera2():
-    print("\n[3/3] A verificar biblioteca Python (Picamera2)...")
+def check_picamera2(out=sys.stdout):
+    """Importa o Picamera2 e lista as câmeras sem abrir nenhuma; devolve a classe ou None"""
+    print("\n[3/3] A verificar biblioteca Python (Picamera2)...", file=out)
     
     try:
         from picamera2 import Picamera2
-        print("✓ Biblioteca Picamera2 instalada.")
+        print("✓ Biblioteca Picamera2 instalada.", file=out)
         
-        try:
-            # Tenta inicializar a câmera 0 com a API moderna
-            picam = Picamera2(0)
-            
-            # Cria uma configuração simples (preview) para testar
-            config = picam.create_preview_configuration()
-            picam.configure(config)
-            
-            # Se chegou aqui sem erro, a câmera está acessível
-            picam.close()
-            print(f"✓ Picamera2 consegue aceder à câmera 0.")
-            return True
-            
-        except Exception as e:
-            print(f"⚠ Picamera2 instalada, mas erro ao aceder à câmera: {e}")
-            return False
+        # Sonda estática: lê as câmeras do libcamera sem abrir nenhuma
+        camera_info = Picamera2.global_camera_info()
+        if not camera_info:
+            print("✗ Picamera2 não vê nenhuma câmera.", file=out)
+            return None
+        for idx, info in enumerate(camera_info):
+            print(f"  Câmera {idx}: {info.get('Model', 'Desconhecido')}", file=out)
+        return Picamera2
             
     except ImportError:
-        print("✗ Picamera2 não instalado")
-        print("  Instale com: sudo apt install python3-picamera2")
+        print("✗ Picamera2 não instalado", file=out)
+        print("  Instale com: sudo apt install python3-picamera2", file=out)
+        return None
+
+
+def check_camera_access(Picamera2, out=sys.stdout):
+    """Abre e configura a câmera 0 (acesso exclusivo: não pode correr com o rpicam-hello)"""
+    try:
+        # Tenta inicializar a câmera 0 com a API moderna
+        picam = Picamera2(0)
+        
+        # Cria uma configuração simples (preview) para testar
+        config = picam.create_preview_configuration()
+        picam.configure(config)
+        
+        # Se chegou aqui sem erro, a câmera está acessível
+        picam.close()
+        print(f"✓ Picamera2 consegue aceder à câmera 0.", file=out)
+        return True
+        
+    except Exception as e:
+        print(f"⚠ Picamera2 instalada, mas erro ao aceder à câmera: {e}", file=out)
         return False
 
 # ============================================================================
@@ -122,8 +144,21 @@ def check_picamera2():
 
 def main():
     cmd_tool = check_libcamera()
-    num_cameras = list_cameras(cmd_tool)
-    py_ok = check_picamera2()
+    
+    # A listagem e a sonda do Picamera2 (sem abrir câmeras) correm em paralelo,
+    # cada uma com o seu buffer de output, que é impresso depois pela ordem original
+    list_out, py_out = io.StringIO(), io.StringIO()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        list_future = pool.submit(list_cameras, cmd_tool, list_out)
+        py_future = pool.submit(check_picamera2, py_out)
+        num_cameras = list_future.result()
+        Picamera2 = py_future.result()
+    sys.stdout.write(list_out.getvalue())
+    sys.stdout.write(py_out.getvalue())
+    
+    # O rpicam-hello --list-cameras adquire cada câmera (acesso exclusivo no
+    # libcamera): a câmera 0 só é aberta depois de ele terminar, senão EBUSY
+    py_ok = Picamera2 is not None and check_camera_access(Picamera2)
     
     print("\n" + "="*60)
     print("RESUMO DA VALIDAÇÃO")
@@ -6,7 +6,7 @@ PROPÓSITO: Valida que YOLOv26 carrega e executa inferência no Raspberry Pi
 VERSÃO: 2.0 (12/02/26)
 
 FUNCIONALIDADE:
-1. Carrega modelo YOLOv26 (PyTorch .pt ou OpenVINO)
+1. Carrega modelo YOLOv26 (PyTorch .pt, ou exportado para NCNN/OpenVINO INT8/ONNX INT8)
 2. Executa inferência numa(s) imagem(ns) de teste
 3. Mostra deteções (classe + confiança + bounding boxes )
 4. Suporta processamento de imagem única ou uma pasta completa
@@ -14,22 +14,58 @@ FUNCIONALIDADE:
 EXECUÇÃO: 
    python3 yolo_test_pi.py --image ./test.jpg
    python3 yolo_test_pi.py --input-dir ./camera_test_images/
+   python3 yolo_test_pi.py --image ./test.jpg --format ncnn
+   python3 yolo_test_pi.py --input-dir ./camera_test_images/ --quantize int8
+   python3 yolo_test_pi.py --serve   (modelo fica carregado; --image/--input-dir usam-no)
 
-NOTA: O YOLO faz resize automático da imagem. Por isso, imagens de 8MP,
-      12MP ou 16MP funcionam todas da mesma forma.
+NOTA: O YOLO faz resize automático da imagem para --imgsz (default 320). Por
+      isso, imagens de 8MP, 12MP ou 16MP funcionam todas da mesma forma.
+      320 custa ~1/4 do cálculo de 640, mas objetos muito pequenos podem
+      perder-se: para insetos de 2-3mm em imagem inteira usar 640 ou o SAHI.py.
 """
 
+import os
 import sys
+import csv
+import json
+import time
+import stat
+import socket
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import chain, islice
 from pathlib import Path
 
-# Tenta importar Ultralytics YOLO
+# Threads de inferência: um por core (4 no Pi 5), sem oversubscription
+# (variáveis de ambiente têm de ser definidas antes de importar numpy/torch)
+INFERENCE_THREADS = os.cpu_count() or 4
+for _var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+    os.environ.setdefault(_var, str(INFERENCE_THREADS))
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# PyTurboJPEG é opcional: descodifica JPEG com libjpeg-turbo (IDCT NEON) direto do
+# buffer, com a escala reduzida na mesma chamada; sem ele usa o cv2.imread
 try:
-    from ultralytics import YOLO
-except ImportError:
-    print("ERRO: Ultralytics não instalado")
-    print("Execute: pip install ultralytics")
-    sys.exit(1)
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
+
+# O import do Ultralytics (PyTorch) demora segundos no Pi: só é feito quando é
+# preciso carregar/exportar o modelo (o cliente do modo --serve não precisa dele)
+def import_yolo():
+    """Importa a classe YOLO do Ultralytics (termina se não estiver instalado)"""
+    try:
+        from ultralytics import YOLO
+    except ImportError:
+        print("ERRO: Ultralytics não instalado")
+        print("Execute: pip install ultralytics")
+        sys.exit(1)
+    return YOLO
 
 print("="*60)
 print("TESTE DE INFERÊNCIA - YOLOv26 no Raspberry Pi 5")
@@ -42,11 +78,189 @@ print("="*60)
 # Modelo YOLOv26 (estou a usar YOLOv11 por agora)
 DEFAULT_MODEL = "yolo11s.pt"  # ou "yolo26s_openvino_model/" para OpenVINO
 
+# Formatos de exportação (runtimes otimizados para ARM/CPU), em cache ao lado do .pt
+# ncnn: kernels NEON, pesos em FP16 | openvino: INT8 quantizado (calibração em CALIBRATION_DATA)
+# com shape estático [1, 3, imgsz, imgsz]: o runtime compila um só plano, sem reshape
+CALIBRATION_DATA = "coco8.yaml"  # trocar pelo dataset dos insetos para calibrar o INT8
+EXPORT_FORMATS = {
+    'ncnn': {'half': True},
+    'openvino': {'int8': True, 'data': CALIBRATION_DATA, 'dynamic': False, 'half': False},
+}
+
+# Quantização estática INT8 do ONNX (--quantize int8): calibrada com as primeiras
+# imagens do --input-dir (200-500 imagens representativas chegam)
+CALIBRATION_IMAGES = 200
+LETTERBOX_COLOR = (114, 114, 114)  # cor do padding do letterbox do Ultralytics
+
 # Threshold de confiança mínimo para deteções
 CONFIDENCE_THRESHOLD = 0.25   # podemos mudar
 
+# Inferência
+DEFAULT_IMGSZ = 320       # Resolução de entrada do YOLO (também fixada na exportação)
+DEFAULT_BATCH_SIZE = 8    # Imagens por forward pass (modelos exportados: sempre 1)
+
+# Descodificação JPEG reduzida (IDCT escalado do libjpeg-turbo): 2/4/8x menos
+# pixels, usada só enquanto o lado maior continuar >= imgsz (o letterbox do YOLO
+# reduziria a imagem a imgsz de qualquer forma)
+JPEG_EXTENSIONS = frozenset({'jpg', 'jpeg'})
+REDUCED_DECODE = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# Modo servidor (--serve): modelo carregado uma vez, pedidos por Unix socket
+# ($XDG_RUNTIME_DIR é privado do utilizador; o /tmp é partilhado, por isso o
+# cliente só usa sockets que sejam do próprio utilizador)
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp', 'yolo.sock')
+
+# Tempos por imagem (--csv): uma linha por imagem, acrescentada ao ficheiro
+CSV_HEADER = ("image", "detections", "inference_ms")
+
 # Formatos de imagem suportados 
-SUPPORTED_FORMATS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
+SUPPORTED_FORMATS = frozenset({'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'})
+# Mesmas extensões sem o ponto: comparadas direto com o fim do nome do ficheiro
+SUPPORTED_EXTENSIONS = frozenset(fmt[1:] for fmt in SUPPORTED_FORMATS)
+
+# ============================================================================
+# FUNÇÃO: CONFIGURAR THREADS DO PYTORCH
+# ============================================================================
+
+def configure_cpu_threads():
+    """Fixa 1 thread inter-op no PyTorch (só é possível antes do 1º trabalho paralelo)"""
+    import_yolo()  # garante que o torch está disponível (vem com o Ultralytics)
+    import torch
+    torch.set_num_interop_threads(1)
+
+
+def apply_inference_threads():
+    """Repõe INFERENCE_THREADS no PyTorch (chamar depois do 1º predict)"""
+    # O 1º predict do Ultralytics (select_device) faz torch.set_num_threads(min(8, cores - 1)),
+    # 3 no Pi 5: definido antes disso seria reposto em silêncio
+    import torch
+    torch.set_num_threads(INFERENCE_THREADS)
+
+# ============================================================================
+# FUNÇÃO: EXPORTAR MODELO (NCNN / OPENVINO)
+# ============================================================================
+
+def export_model(model_path, export_format, imgsz):
+    """Exporta modelo .pt para NCNN/OpenVINO (só na primeira vez)"""
+    # imgsz no nome: o shape fica fixo na exportação, cada resolução tem a sua pasta
+    # (o sufixo _<formato>_model é o que o Ultralytics usa para escolher o runtime)
+    pt_path = Path(model_path)
+    if export_format == 'openvino':
+        exported_path = pt_path.with_name(f"{pt_path.stem}_{imgsz}_int8_openvino_model")
+    else:
+        exported_path = pt_path.with_name(f"{pt_path.stem}_{imgsz}_{export_format}_model")
+    
+    # Reutiliza exportação anterior
+    if exported_path.exists():
+        print(f"\n✓ Modelo exportado já existe: {exported_path}")
+        return str(exported_path)
+    
+    print(f"\n[0/3] A exportar {model_path} para {export_format.upper()} (pode demorar)...")
+    YOLO = import_yolo()
+    try:
+        exported = YOLO(model_path).export(
+            format=export_format,
+            imgsz=imgsz,
+            **EXPORT_FORMATS[export_format]
+        )
+        Path(exported).rename(exported_path)
+        print(f"✓ Modelo exportado: {exported_path}")
+        return str(exported_path)
+    except Exception as e:
+        print(f"✗ Erro ao exportar modelo: {e}")
+        return None
+
+# ============================================================================
+# FUNÇÃO: QUANTIZAR MODELO (ONNX INT8)
+# ============================================================================
+
+def letterbox(image, imgsz):
+    """Redimensiona mantendo a proporção e completa com padding até imgsz x imgsz (como o Ultralytics)"""
+    h, w = image.shape[:2]
+    ratio = min(imgsz / h, imgsz / w)
+    new_w, new_h = round(w * ratio), round(h * ratio)
+    resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, left = (imgsz - new_h) // 2, (imgsz - new_w) // 2
+    return cv2.copyMakeBorder(resized, top, imgsz - new_h - top, left, imgsz - new_w - left,
+                              cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR)
+
+
+class CalibrationReader:
+    """Fornece ao quantize_static as imagens de calibração, já no formato de entrada do modelo"""
+
+    def __init__(self, image_paths, imgsz, input_name):
+        self.samples = (
+            {input_name: self.preprocess(image, imgsz)}
+            for image, _ in (decode_image(p, imgsz) for p in image_paths)
+            if image is not None
+        )
+
+    @staticmethod
+    def preprocess(image, imgsz):
+        """BGR HWC uint8 -> RGB NCHW float32 em [0, 1] (o que o modelo exportado recebe)"""
+        rgb = cv2.cvtColor(letterbox(image, imgsz), cv2.COLOR_BGR2RGB)
+        return np.ascontiguousarray(rgb.transpose(2, 0, 1)[None], dtype=np.float32) / 255
+
+    def get_next(self):
+        return next(self.samples, None)
+
+
+def quantize_model(model_path, imgsz, calibration_dir):
+    """Exporta o .pt para ONNX e quantiza-o para INT8 estático (só na primeira vez)"""
+    # Mesma convenção do export_model: shape fixo, imgsz no nome; o Ultralytics
+    # escolhe o ONNXRuntime pela extensão .onnx
+    pt_path = Path(model_path)
+    onnx_path = pt_path.with_name(f"{pt_path.stem}_{imgsz}.onnx")
+    quant_path = pt_path.with_name(f"{pt_path.stem}_{imgsz}_int8.onnx")
+
+    # Reutiliza quantização anterior
+    if quant_path.exists():
+        print(f"\n✓ Modelo quantizado já existe: {quant_path}")
+        return str(quant_path)
+
+    if calibration_dir is None:
+        print("\n✗ A quantização INT8 precisa de imagens de calibração: use --input-dir")
+        return None
+
+    try:
+        import onnxruntime
+        from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+    except ImportError:
+        print("\n✗ ONNXRuntime não instalado")
+        print("Execute: pip install onnxruntime")
+        return None
+
+    print(f"\n[0/3] A quantizar {model_path} para ONNX INT8 (pode demorar)...")
+    YOLO = import_yolo()
+    try:
+        if not onnx_path.exists():
+            exported = YOLO(model_path).export(format='onnx', imgsz=imgsz, dynamic=False, simplify=True)
+            Path(exported).rename(onnx_path)
+
+        session = onnxruntime.InferenceSession(str(onnx_path), providers=['CPUExecutionProvider'])
+        calibration_images = islice(iter_images(calibration_dir), CALIBRATION_IMAGES)
+        reader = CalibrationReader(calibration_images, imgsz, session.get_inputs()[0].name)
+        del session
+
+        # QDQ com pesos INT8 por canal e ativações UINT8 (produtos int8 por NEON)
+        quantize_static(
+            str(onnx_path),
+            str(quant_path),
+            calibration_data_reader=reader,
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            weight_type=QuantType.QInt8,
+            activation_type=QuantType.QUInt8,
+        )
+        print(f"✓ Modelo quantizado: {quant_path}")
+        return str(quant_path)
+    except Exception as e:
+        print(f"✗ Erro ao quantizar modelo: {e}")
+        return None
 
 # ============================================================================
 # FUNÇÃO: CARREGAR MODELO
@@ -69,10 +283,21 @@ def load_model(model_path):
         print("  2. Ou treine: yolo train model=yolo11s.pt data=dataset.yaml")
         return None
     
+    # Modelos exportados: Ultralytics escolhe o runtime pelo nome
+    if model_path.rstrip('/').endswith('_ncnn_model'):
+        backend = "NCNN"
+    elif model_path.rstrip('/').endswith('_openvino_model'):
+        backend = "OpenVINO"
+    elif model_path.endswith('.onnx'):
+        backend = "ONNXRuntime"
+    else:
+        backend = "PyTorch"
+    
+    YOLO = import_yolo()
     try:
         # Carrega modelo (Ultralytics baixa automático se for standard)
-        model = YOLO(model_path)
-        print(f"✓ Modelo carregado com sucesso")
+        model = YOLO(model_path, task='detect')
+        print(f"✓ Modelo carregado com sucesso ({backend})")
         print(f"  Classes: {list(model.names.values())}")
         return model
     except Exception as e:
@@ -80,78 +305,296 @@ def load_model(model_path):
         return None
 
 
+def warmup_model(model, imgsz):
+    """Forward pass com imagem vazia (inicializa threads/kernels antes da 1ª imagem real)"""
+    print(f"  A aquecer o modelo ({imgsz}x{imgsz})...")
+    model(
+        np.zeros((imgsz, imgsz, 3), dtype=np.uint8),
+        imgsz=imgsz,
+        device='cpu',
+        verbose=False
+    )
+
+
 # ============================================================================
 # FUNÇÃO: EXECUTAR INFERÊNCIA
 # ============================================================================
 
-def run_inference(model, image_path, conf_threshold):
-    """Executa inferência YOLOv26 numa imagem"""
-    print(f"\n[2/3] Inferência em: {Path(image_path).name}")
+def decode_jpeg_turbo(image_path, imgsz):
+    """Descodifica um JPEG com TurboJPEG (BGR), reduzido enquanto o lado maior for >= imgsz"""
+    try:
+        with open(image_path, 'rb') as f:
+            jpeg_buf = f.read()
+        width, height, _, _ = turbo_jpeg.decode_header(jpeg_buf)
+        long_side = max(width, height)
+        for factor, _ in REDUCED_DECODE:
+            if long_side // factor >= imgsz:
+                return turbo_jpeg.decode(jpeg_buf, pixel_format=TJPF_BGR, scaling_factor=(1, factor)), factor
+        return turbo_jpeg.decode(jpeg_buf, pixel_format=TJPF_BGR), 1
+    except OSError:
+        # Ficheiro ilegível ou JPEG corrompido: mesmo contrato do cv2.imread
+        return None, 1
+
+
+def decode_image(image_path, imgsz):
+    """Lê e descodifica uma imagem (BGR); devolve (imagem ou None, fator de redução)"""
+    if image_path.name.rpartition('.')[2].lower() in JPEG_EXTENSIONS:
+        if turbo_jpeg is not None:
+            return decode_jpeg_turbo(image_path, imgsz)
+        try:
+            # Só o cabeçalho é lido aqui (o PIL descodifica de forma preguiçosa)
+            with Image.open(image_path) as header:
+                long_side = max(header.size)
+        except OSError:
+            long_side = 0
+        for factor, flag in REDUCED_DECODE:
+            if long_side // factor >= imgsz:
+                return cv2.imread(str(image_path), flag), factor
+    return cv2.imread(str(image_path)), 1
+
+
+def decode_images(image_paths, imgsz):
+    """Descodifica um lote de imagens (BGR, como o Ultralytics espera)"""
+    return [decode_image(p, imgsz) for p in image_paths]
+
+
+def run_inference(model, images, conf_threshold, imgsz, quiet=False):
+    """Executa inferência YOLOv26 num lote de imagens já descodificadas; devolve (resultados, ms)"""
+    if not quiet:
+        print(f"\n[2/3] Inferência em lote: {len(images)} imagem(ns)")
     
     try:
         # Executa deteção ( força device='cpu' pois o Raspberry Pi nao tem GPU)
+        # Ultralytics faz o letterbox de todas as imagens e junta-as num só tensor
+        # stream=True: gerador em vez da lista de Results (cada um com a imagem
+        # original), cada resultado é libertado depois de mostrado
+        start_ns = time.perf_counter_ns()
         results = model(
-            image_path,
+            images,
             conf=conf_threshold,
+            imgsz=imgsz,
+            batch=len(images),  # sem isto o Ultralytics processa a lista 1 a 1
             device='cpu',
-            verbose=False
+            verbose=False,
+            stream=True
         )
+        # O gerador é preguiçoso: o forward pass (e o NMS) do lote inteiro corre
+        # até ao primeiro resultado, é isso que é cronometrado
+        first_result = next(results)
+        elapsed_ms = (time.perf_counter_ns() - start_ns) / 1e6
         
-        # Extrai primeiro resultado (single image)
-        result = results[0]
-        num_detections = len(result.boxes)
-        
-        print(f"✓ Inferência concluída")
-        print(f"  Deteções (conf ≥ {conf_threshold}): {num_detections}")
-        
-        return result, num_detections
+        if not quiet:
+            print(f"✓ Inferência concluída ({elapsed_ms:.1f} ms)")
+        return chain([first_result], results), elapsed_ms
         
     except Exception as e:
         print(f"✗ Erro durante inferência: {e}")
-        return None, 0
+        return None, 0.0
 
 # ============================================================================
 # FUNÇÃO: MOSTRAR RESULTADOS
 # ============================================================================
 
-def display_results(model, result, num_detections):
-    """Mostra deteções no terminal"""
-    print(f"\n[3/3] RESULTADOS:")
-    print("="*60)
+def result_to_detections(class_names, result, scale=1):
+    """Converte um resultado Ultralytics numa lista de deteções (dicts, serializável em JSON)"""
+    # Uma só cópia tensor -> NumPy -> floats Python, em vez de indexar o tensor
+    # por deteção; colunas (x1, y1, x2, y2, conf, cls)
+    # scale devolve as caixas às coordenadas da imagem original (descodificação reduzida)
+    return [
+        {"class": class_names[int(cls_id)], "conf": conf,
+         "bbox": [x1 * scale, y1 * scale, x2 * scale, y2 * scale]}
+        for x1, y1, x2, y2, conf, cls_id in result.boxes.data.cpu().numpy().tolist()
+    ]
+
+
+def display_results(detections):
+    """Mostra deteções no terminal (uma só escrita no stdout)"""
+    lines = [f"\n[3/3] RESULTADOS:\n", "="*60 + "\n"]
     
-    if num_detections == 0:
-        print("  Nenhuma deteção acima do threshold")
+    if not detections:
+        lines.append("  Nenhuma deteção acima do threshold\n")
     else:
-        print(f"  Total de deteções: {num_detections}\n")
+        lines.append(f"  Total de deteções: {len(detections)}\n\n")
         
         # Itera sobre cada deteção
-        for i in range(num_detections):
-            cls_id = int(result.boxes.cls[i])
-            conf = float(result.boxes.conf[i])
-            class_name = model.names[cls_id]
+        for i, det in enumerate(detections, 1):
+            conf = det["conf"]
+            x1, y1, x2, y2 = det["bbox"]
             
-            # Bounding box (x1, y1, x2, y2)
-            box = result.boxes.xyxy[i].cpu().numpy()
-            
-            print(f"  [{i+1}] {class_name}")
-            print(f"      Confiança: {conf:.3f} ({conf*100:.1f}%)")
-            print(f"      BoundingBox: ({box[0]:.0f}, {box[1]:.0f}) → ({box[2]:.0f}, {box[3]:.0f})")
+            lines.append(
+                f"  [{i}] {det['class']}\n"
+                f"      Confiança: {conf:.3f} ({conf*100:.1f}%)\n"
+                f"      BoundingBox: ({x1:.0f}, {y1:.0f}) → ({x2:.0f}, {y2:.0f})\n"
+            )
     
-    print("="*60)
+    lines.append("="*60 + "\n")
+    sys.stdout.write("".join(lines))
     
+def report_image(index, num_images, img_path, detections, conf_threshold, quiet):
+    """Mostra o resultado de uma imagem: detalhado, ou uma só linha com --quiet"""
+    if quiet:
+        sys.stdout.write(f"[{index}/{num_images}] {img_path.name}: {len(detections)} deteção(ões)\n")
+        return
+    
+    print(f"\n{'='*60}\n"
+          f"[{index}/{num_images}] PROCESSANDO: {img_path.name}\n"
+          f"{'='*60}\n"
+          f"  Deteções (conf ≥ {conf_threshold}): {len(detections)}")
+    display_results(detections)
+    
+# ============================================================================
+# MODO SERVIDOR (--serve) E CLIENTE
+# ============================================================================
+
+def is_own_socket(socket_path):
+    """True se o caminho for um Unix socket do utilizador atual (não de outro utilizador no /tmp)"""
+    try:
+        st = os.lstat(socket_path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def serve(model, class_names, socket_path, conf_threshold, imgsz):
+    """Responde a caminhos de imagens (um por linha) com as deteções em JSON, até Ctrl+C"""
+    # Socket de uma execução anterior que não terminou limpa
+    if is_own_socket(socket_path):
+        os.unlink(socket_path)
+    
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+    except OSError as e:
+        print(f"\n✗ Não foi possível criar o socket {socket_path}: {e}")
+        server.close()
+        return None
+    os.chmod(socket_path, 0o600)  # só o próprio utilizador pode ligar-se
+    server.listen()
+    print(f"\n✓ Servidor à escuta em {socket_path} (Ctrl+C para parar)")
+    
+    num_images = 0
+    try:
+        while True:
+            conn, _ = server.accept()
+            # Cliente que desliga a meio (BrokenPipe/ConnectionReset) ou envia lixo:
+            # fecha só esta ligação e volta ao accept()
+            try:
+                # Leitura e escrita em ficheiros separados: no mesmo TextIOWrapper 'rw'
+                # cada write descarta as linhas já lidas para o buffer (pedidos seguidos perdidos)
+                with (conn, conn.makefile('r', encoding='utf-8') as reader,
+                      conn.makefile('w', encoding='utf-8') as writer):
+                    for line in reader:
+                        image_path = line.strip()
+                        if not image_path:
+                            continue
+                        
+                        reply = {"image": image_path, "conf_threshold": conf_threshold}
+                        try:
+                            result = model(image_path, conf=conf_threshold, imgsz=imgsz,
+                                           device='cpu', verbose=False)[0]
+                            reply["detections"] = result_to_detections(class_names, result)
+                        except Exception as e:
+                            reply["error"] = str(e)
+                        
+                        writer.write(json.dumps(reply) + "\n")
+                        writer.flush()
+                        num_images += 1
+                        print(f"  [{num_images}] {Path(image_path).name}: "
+                              f"{len(reply.get('detections', ()))} deteção(ões)")
+            except (OSError, UnicodeDecodeError) as e:
+                print(f"  ⚠ Ligação do cliente terminada a meio: {e}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(socket_path)
+    
+    return num_images
+
+
+def run_with_server(socket_path, images, num_images, quiet=False):
+    """Envia as imagens ao servidor --serve; devolve (imagens, deteções) ou None se não responder"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError as e:
+        # Socket antigo sem servidor: carrega o modelo neste processo
+        print(f"⚠ Servidor em {socket_path} não responde ({e}), a carregar o modelo aqui")
+        client.close()
+        return None
+    
+    print(f"✓ A usar o servidor em {socket_path} (conf/imgsz/modelo do servidor)")
+    num_served = total_detections = 0
+    with (client, client.makefile('r', encoding='utf-8') as reader,
+          client.makefile('w', encoding='utf-8') as writer):
+        for i, img_path in enumerate(images, 1):
+            # Caminho absoluto: o servidor pode correr noutra pasta
+            try:
+                writer.write(f"{img_path.absolute()}\n")
+                writer.flush()
+                line = reader.readline()
+            except OSError:
+                line = ""
+            if not line:
+                # Servidor parado a meio: o resumo conta só as imagens respondidas
+                print(f"✗ [{i}/{num_images}] O servidor em {socket_path} fechou a ligação")
+                break
+            reply = json.loads(line)
+            num_served = i
+            
+            if "error" in reply:
+                print(f"✗ [{i}/{num_images}] Erro durante inferência (servidor) em "
+                      f"{img_path.name}: {reply['error']}")
+                continue
+            report_image(i, num_images, img_path, reply["detections"], reply["conf_threshold"], quiet)
+            total_detections += len(reply["detections"])
+    
+    return num_served, total_detections
+
 # ============================================================================
-# FUNÇÃO: VALIDAR FORMATOS DE IMAGEM 
+# FUNÇÃO: LISTAR IMAGENS DA PASTA
 # ============================================================================
 
-def get_valid_images(path_list):
-    """Filtra apenas ficheiros de imagem válidos"""
-    valid = []
-    for p in path_list:
-        if p.suffix.lower() in SUPPORTED_FORMATS:
-            valid.append(p)
-        else:
-            print(f"⚠ Ignorado (formato não suportado): {p.name}")
-    return valid
+def iter_images(dir_path):
+    """Percorre as imagens suportadas de uma pasta à medida que o scandir as lê (sem lista)"""
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            # Extensão direto do nome (sem criar Path/splitext por ficheiro);
+            # o Path só é criado para as entradas que passam o filtro
+            _, dot, extension = entry.name.rpartition('.')
+            if (dot and extension.lower() in SUPPORTED_EXTENSIONS
+                    and entry.is_file(follow_symlinks=False)):
+                yield Path(entry.path)
+
+
+def iter_batches(images, batch_size):
+    """Agrupa as imagens em lotes de até batch_size (memória O(lote), não O(pasta))"""
+    images = iter(images)
+    while batch := list(islice(images, batch_size)):
+        yield batch
+
+
+def open_csv(csv_path):
+    """Abre o CSV de tempos em modo append, com buffer de linha (cabeçalho se estiver vazio)"""
+    if csv_path is None:
+        return nullcontext()
+    # newline='': o csv.writer trata das quebras de linha (e de aspas/vírgulas nos caminhos)
+    csv_file = open(csv_path, 'a', buffering=1, encoding='utf-8', newline='')
+    if csv_file.tell() == 0:
+        csv.writer(csv_file, lineterminator='\n').writerow(CSV_HEADER)
+    return csv_file
+
+
+def print_summary(num_images, total_detections, inference_ms=None, num_inferred=0):
+    """Mostra o resumo final"""
+    print("\n" + "="*60)
+    print("RESUMO FINAL")
+    print("="*60)
+    print(f"  Imagens processadas: {num_images}")
+    print(f"  Total de deteções: {total_detections}")
+    if num_inferred:
+        print(f"  Tempo de inferência: {inference_ms:.0f} ms ({inference_ms / num_inferred:.1f} ms/imagem)")
+    print("\n✅ YOLOv11 FUNCIONAL NO RASPBERRY PI 5!")
 
 
 # ============================================================================
@@ -170,6 +613,26 @@ def main():
         '--input-dir',
         help='Pasta com múltiplas imagens (processa todas *.jpg/*.png)'
     )
+    parser.add_argument(
+        '--quiet',
+        action='store_true',
+        help='Uma linha por imagem (nº de deteções) em vez do detalhe de cada deteção'
+    )
+    parser.add_argument(
+        '--csv',
+        help='Acrescenta a este CSV o nº de deteções e o tempo de inferência (ms) de cada imagem '
+             '(só inferência local, não pelo servidor)'
+    )
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help='Modo servidor: carrega o modelo uma vez e atende pedidos no --socket'
+    )
+    parser.add_argument(
+        '--socket',
+        default=SOCKET_PATH,
+        help=f'Unix socket do modo servidor; se existir e for do utilizador, --image/--input-dir usam-no (default: {SOCKET_PATH})'
+    )
     parser.add_argument(
         '--model',
         default=DEFAULT_MODEL,
@@ -181,84 +644,191 @@ def main():
         default=CONFIDENCE_THRESHOLD,
         help=f'Threshold de confiança (default: {CONFIDENCE_THRESHOLD})'
     )
+    parser.add_argument(
+        '--format',
+        choices=['pt', *sorted(EXPORT_FORMATS)],
+        default='pt',
+        help='Runtime do modelo: pt (PyTorch) ou exporta o .pt para NCNN/OpenVINO INT8 (default: pt)'
+    )
+    parser.add_argument(
+        '--quantize',
+        choices=['int8'],
+        help=f'Exporta o .pt para ONNX e quantiza-o para INT8 estático, calibrado com as '
+             f'primeiras {CALIBRATION_IMAGES} imagens do --input-dir'
+    )
+    parser.add_argument(
+        '--imgsz',
+        type=int,
+        default=DEFAULT_IMGSZ,
+        help=f'Resolução de entrada do YOLO, múltiplo de 32; menor = mais rápido mas '
+             f'perde objetos pequenos (default: {DEFAULT_IMGSZ}, 640 = padrão YOLO)'
+    )
+    parser.add_argument(
+        '--batch',
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f'Imagens por forward pass do YOLO (default: {DEFAULT_BATCH_SIZE})'
+    )
     
     args = parser.parse_args()
     
-    # Validação: precisa de --image OU --input-dir
-    if not args.image and not args.input_dir:
-        print("\n✗ Erro: Forneça --image ou --input-dir")
+    # O stride máximo do YOLO é 32: outros valores seriam arredondados em silêncio
+    if args.imgsz < 32 or args.imgsz % 32:
+        parser.error(f"--imgsz tem de ser múltiplo de 32 e >= 32 (ex: 320, 416, 640), recebido {args.imgsz}")
+    if args.batch < 1:
+        parser.error(f"--batch tem de ser pelo menos 1, recebido {args.batch}")
+    if args.quantize and args.format != 'pt':
+        parser.error("--quantize não se combina com --format (o modelo quantizado é ONNX)")
+    
+    # Validação: precisa de --image, --input-dir OU --serve
+    if not args.image and not args.input_dir and not args.serve:
+        print("\n✗ Erro: Forneça --image, --input-dir ou --serve")
         print("Exemplos:")
         print("  python3 yolo_test_pi.py --image test.jpg")
         print("  python3 yolo_test_pi.py --input-dir ./test_images/")
+        print("  python3 yolo_test_pi.py --serve")
         return 1
     
-    # Determina lista de imagens a processar
+    # Determina as imagens a processar (pasta: lidas à medida, total desconhecido)
     images = []
-    if args.input_dir:
+    num_images = 0
+    if args.serve:
+        pass
+    elif args.input_dir:
         # Modo: Pasta completa
         dir_path = Path(args.input_dir)
         if not dir_path.exists():
             print(f"\n✗ Pasta não encontrada: {dir_path}")
             return 1
-        # Recolhe TODOS os formatos suportados
-        all_files = []
-        for fmt in SUPPORTED_FORMATS:
-            all_files.extend(dir_path.glob(f"*{fmt}"))
+        # Todos os formatos suportados, numa só leitura da pasta em streaming
+        images = iter_images(dir_path)
+        first_image = next(images, None)
         
-        images = get_valid_images(all_files)  
-        
-        if not images:
+        if first_image is None:
             print(f"\n✗ Nenhuma imagem válida encontrada em: {dir_path}")
             print(f"  Formatos suportados: {', '.join(SUPPORTED_FORMATS)}")
             return 1
-        print(f"✓ Encontradas {len(images)} imagens em: {dir_path}")
+        images = chain([first_image], images)
+        num_images = "?"
+        print(f"✓ A processar as imagens de: {dir_path}")
 
     else:
-        # Modo: Ficheiro único
-        img_path = Path(args.image)
-        if not img_path.exists():
-            print(f"\n✗ Imagem não encontrada: {img_path}")
+        # Modo: Ficheiro único (um só stat; extensão direto da string, como no iter_images)
+        image = args.image
+        if not os.path.isfile(image):
+            print(f"\n✗ Imagem não encontrada: {image}")
             return 1
         
         # VALIDAÇÃO DE FORMATO
-        if img_path.suffix.lower() not in SUPPORTED_FORMATS:
-            print(f"\n✗ Formato não suportado: {img_path.suffix}")
+        _, dot, extension = os.path.basename(image).rpartition('.')
+        if not dot or extension.lower() not in SUPPORTED_EXTENSIONS:
+            print(f"\n✗ Formato não suportado: {'.' + extension if dot else image}")
             print(f"  Formatos aceites: {', '.join(SUPPORTED_FORMATS)}")
             return 1
         
+        img_path = Path(image)
         images = [img_path]
+        num_images = 1
         print(f"✓ Imagem encontrada: {img_path.name}")
 
     
+    # Servidor --serve já a correr: envia-lhe as imagens (sem carregar o modelo aqui)
+    if not args.serve and is_own_socket(args.socket):
+        served = run_with_server(args.socket, images, num_images, args.quiet)
+        if served is not None:
+            print_summary(*served)
+            return 0
+    
+    # PASSO 0 (opcional): Exporta para runtime otimizado
+    model_path = args.model
+    if args.format != 'pt' and model_path.endswith('.pt'):
+        model_path = export_model(args.model, args.format, args.imgsz)
+        if model_path is None:
+            return 1
+    elif args.quantize and model_path.endswith('.pt'):
+        model_path = quantize_model(args.model, args.imgsz, args.input_dir)
+        if model_path is None:
+            return 1
+    
+    # Modelos exportados (NCNN, OpenVINO/ONNX com shape fixo) só processam 1 imagem por forward pass
+    if not model_path.endswith('.pt') and args.batch > 1:
+        print("⚠ Modelo exportado não suporta batch, a usar --batch 1")
+        args.batch = 1
+    
+    configure_cpu_threads()
+    
     # PASSO 1: Carrega o modelo (uma vez só)
-    model = load_model(args.model)
+    model = load_model(model_path)
     if model is None:
         return 1
+    warmup_model(model, args.imgsz)
+    apply_inference_threads()
+    
+    # Nomes das classes indexados pelo id (tuplo em vez do dict model.names)
+    class_names = tuple(model.names[i] for i in range(len(model.names)))
+    
+    if args.serve:
+        num_images = serve(model, class_names, args.socket, args.conf, args.imgsz)
+        if num_images is None:
+            return 1
+        print(f"\n✓ Servidor parado ({num_images} imagens processadas)")
+        return 0
     
     # PASSO 2 e 3: Processa todas as imagens
     total_detections = 0
-    for i, img_path in enumerate(images, 1):
-        print(f"\n{'='*60}")
-        print(f"[{i}/{len(images)}] PROCESSANDO: {img_path.name}")
-        print('='*60)
-        
-        # Executa inferência
-        result, num_detections = run_inference(model, str(img_path), args.conf)
-        if result is None:
-            continue
-        
-        # Mostra resultados
-        display_results(model, result, num_detections)
-        total_detections += num_detections
+    num_processed = 0
+    total_inference_ms = 0.0
+    num_inferred = 0
+    batches = iter_batches(images, args.batch)
     
-    # Resumo final
-    print("\n" + "="*60)
-    print("RESUMO FINAL")
-    print("="*60)
-    print(f"  Imagens processadas: {len(images)}")
-    print(f"  Total de deteções: {total_detections}")
-    print("\n✅ YOLOv11 FUNCIONAL NO RASPBERRY PI 5!")
+    # Descodificação do lote seguinte numa thread enquanto o atual está na inferência
+    # (TurboJPEG/cv2 libertam o GIL, a leitura do SD e o decode ficam escondidos)
+    with ThreadPoolExecutor(max_workers=1) as decoder, open_csv(args.csv) as csv_file:
+        csv_writer = csv.writer(csv_file, lineterminator='\n') if csv_file is not None else None
+        batch = next(batches, None)
+        if batch:
+            next_decoded = decoder.submit(decode_images, batch, args.imgsz)
+        
+        while batch:
+            decoded = next_decoded.result()
+            next_batch = next(batches, None)
+            if next_batch:
+                next_decoded = decoder.submit(decode_images, next_batch, args.imgsz)
+            
+            # Imagens que o OpenCV não conseguiu ler ficam de fora do lote
+            entries = []
+            for i, (img_path, (image, scale)) in enumerate(zip(batch, decoded), num_processed + 1):
+                if image is None:
+                    print(f"\n✗ [{i}/{num_images}] Não foi possível ler a imagem: {img_path.name}")
+                else:
+                    entries.append((i, img_path, image, scale))
+            num_processed += len(batch)
+            batch = next_batch
+            if not entries:
+                continue
+            
+            # Executa inferência num lote de até --batch imagens
+            results, elapsed_ms = run_inference(model, [entry[2] for entry in entries], args.conf,
+                                                args.imgsz, args.quiet)
+            if results is None:
+                continue
+            total_inference_ms += elapsed_ms
+            num_inferred += len(entries)
+            # Um forward pass por lote: o tempo de cada imagem é a média do lote
+            image_ms = elapsed_ms / len(entries)
+            
+            # strict=True esgota o gerador: o Ultralytics só liberta o lock do
+            # predictor no fim do stream (senão o lote seguinte bloqueia para sempre)
+            for (i, img_path, _, scale), result in zip(entries, results, strict=True):
+                detections = result_to_detections(class_names, result, scale)
+                
+                # Mostra resultados
+                report_image(i, num_images, img_path, detections, args.conf, args.quiet)
+                total_detections += len(detections)
+                if csv_writer is not None:
+                    csv_writer.writerow((img_path, len(detections), f"{image_ms:.3f}"))
     
+    print_summary(num_processed, total_detections, total_inference_ms, num_inferred)
     return 0
 
 